@@ -0,0 +1,113 @@
+"""Event loop backends under N simulated lounge streams.
+
+Each device reads a chunked long poll that sends an event every 20 ms, parses it and,
+like a skip, schedules a 10 ms timer. The fake lounge runs in its own process so only
+the devices are measured: event latency (sent to parsed), timer lateness and CPU time
+per device.
+
+    python benchmarks/bench_event_loop.py [devices ...]
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from iSponsorBlockTV import event_loop  # noqa: E402
+
+DURATION = 5  # Seconds each run lasts
+EVENT_INTERVAL = 0.02
+TIMER = 0.01
+
+
+def serve(port_queue):
+    async def stream(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        end = time.monotonic() + DURATION
+        event_id = 0
+        while time.monotonic() < end:
+            event_id += 1
+            state = {"currentTime": "12.3", "state": "1", "sent": time.time()}
+            chunk = json.dumps([[event_id, ["onStateChange", state]]])
+            await response.write(f"{len(chunk) + 1}\n{chunk}\n".encode())
+            await asyncio.sleep(EVENT_INTERVAL)
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/bc/bind", stream)
+        server = TestServer(app)
+        await server.start_server(access_log=None)
+        port_queue.put(server.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def device(session, url, latencies, lateness):
+    loop = asyncio.get_running_loop()
+    async with session.get(url) as response:
+        async for line in response.content:
+            if not line.startswith(b"["):
+                continue  # Chunk length
+            event = json.loads(line)
+            latencies.append(time.time() - event[0][1][1]["sent"])
+            due = loop.time() + TIMER
+            loop.call_at(due, lambda due=due: lateness.append(loop.time() - due))
+
+
+async def run_devices(port, count):
+    latencies = []
+    lateness = []
+    url = f"http://127.0.0.1:{port}/bc/bind"
+    cpu = time.process_time()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(device(session, url, latencies, lateness) for _ in range(count)))
+    return latencies, lateness, time.process_time() - cpu
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)] * 1000
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [10, 100, 400]
+    backends = []
+    for name in ("asyncio", "uvloop"):
+        try:
+            event_loop.loop_factory(name)
+            backends.append(name)
+        except ValueError as e:
+            print(f"Skipping {name}: {e}")
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue,), daemon=True)
+    server.start()
+    port = port_queue.get()
+    print("backend  devices  latency p50/p99 (ms)  timer p50/p99 (ms)  cpu/device (ms/s)")
+    try:
+        for count in counts:
+            for name in backends:
+                latencies, lateness, cpu = event_loop.run(run_devices(port, count), name)
+                print(
+                    f"{name:8} {count:7}  {percentile(latencies, 0.5):8.2f} /"
+                    f" {percentile(latencies, 0.99):7.2f}  {percentile(lateness, 0.5):7.2f} /"
+                    f" {percentile(lateness, 0.99):7.2f}  {cpu / count / DURATION * 1000:12.3f}"
+                )
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
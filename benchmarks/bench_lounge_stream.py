@@ -0,0 +1,107 @@
+"""Lounge event delay across poll ends, against the fake lounge in tests/fake_lounge.py.
+
+The fake lounge ends each poll after POLL_LIFETIME and answers every request after
+RTT. An event is pushed every EVENT_INTERVAL, its delay is from being pushed to being
+processed. Three ways of listening:
+  rotation     YtLoungeApi.subscribe, polls replaced before the server ends them
+  no rotation  YtLoungeApi.subscribe, the next poll opened once the last one ended
+  upstream     pyytlounge's subscribe, then an availability check and a new session
+               after every poll, like the device loop in main.py did
+
+    python benchmarks/bench_lounge_stream.py [seconds]
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "tests")]
+
+import pyytlounge  # noqa: E402
+import pyytlounge.wrapper  # noqa: E402
+from aiohttp import ClientSession  # noqa: E402
+from fake_lounge import FakeLounge  # noqa: E402
+
+from iSponsorBlockTV import ytlounge  # noqa: E402
+
+POLL_LIFETIME = 1.5
+RTT = 0.05
+EVENT_INTERVAL = 0.02
+
+
+class TimingLoungeApi(ytlounge.YtLoungeApi):
+    def __init__(self):
+        super().__init__("screen", None, None, logging.getLogger("bench"), "tv")
+        self.mute_ads = False
+        self.skip_ads = False
+        self.received = {}  # Event number: time.monotonic() when processed
+
+    def _process_event(self, event_type, args):
+        self.received.setdefault(args[0], time.monotonic())
+
+
+async def callback(state):
+    pass
+
+
+async def upstream(api, lounge, end):
+    while time.monotonic() < end:
+        await pyytlounge.YtLoungeApi.subscribe(api, callback)
+        await api.is_available()
+        await api.connect()
+
+
+async def run(mode, duration):
+    lounge = await FakeLounge(poll_lifetime=POLL_LIFETIME, poll_delay=RTT).start()
+    ytlounge.api_base = pyytlounge.wrapper.api_base = lounge.api_base
+    api = TimingLoungeApi()
+    api.session = ClientSession()
+    api.auth.lounge_id_token = "token"
+    api.poll_rotation = mode == "rotation"
+    await api.connect()
+    end = time.monotonic() + duration
+    if mode == "upstream":
+        listener = asyncio.create_task(upstream(api, lounge, end))
+    else:
+        listener = asyncio.create_task(api.subscribe(callback))
+    i = 0
+    while time.monotonic() < end:
+        lounge.push("custom", i)
+        i += 1
+        await asyncio.sleep(EVENT_INTERVAL)
+    await asyncio.sleep(POLL_LIFETIME)  # Lets the last events arrive
+    lounge.lose_session()
+    await asyncio.wait_for(listener, POLL_LIFETIME + 1)
+    await api.session.close()
+    await lounge.close()
+    delays = sorted(
+        api.received[i] - pushed for _, (_, i), pushed in lounge.events if i in api.received
+    )
+    return delays, len(lounge.events) - len(delays), len(lounge.polls), lounge.sessions - 1
+
+
+def percentile(values, share):
+    return values[min(int(len(values) * share), len(values) - 1)] * 1000
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ytlounge.MIN_POLL_LIFETIME = POLL_LIFETIME / 2
+    print(
+        f"{duration:g} s, poll lifetime {POLL_LIFETIME} s, rtt {RTT * 1000:g} ms,"
+        f" an event every {EVENT_INTERVAL * 1000:g} ms"
+    )
+    print("mode         delay p50 / p99 / max (ms)  lost  polls  reconnects")
+    for mode in ("rotation", "no rotation", "upstream"):
+        delays, lost, polls, reconnects = asyncio.run(run(mode, duration))
+        print(
+            f"{mode:12} {percentile(delays, 0.5):8.1f} / {percentile(delays, 0.99):6.1f} /"
+            f" {delays[-1] * 1000:6.1f}  {lost:10}  {polls:5}  {reconnects:10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
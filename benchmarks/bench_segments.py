@@ -0,0 +1,63 @@
+"""Segment merging and next segment lookup, before and after the single sweep merge
+and the SegmentIndex.
+
+    python benchmarks/bench_segments.py [segments per video]
+"""
+
+import copy
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), os.path.join(ROOT, "tests")]
+
+from test_segments import old_next_segment, old_process_segments  # noqa: E402
+
+from iSponsorBlockTV.api_helpers import ApiHelper  # noqa: E402
+from iSponsorBlockTV.segments import SegmentIndex  # noqa: E402
+
+
+def make_response(count, rng):
+    segments = []
+    for i in range(count):
+        start = rng.uniform(0, count * 10)
+        segments.append(
+            {
+                "segment": [start, start + rng.uniform(1, 15)],
+                "UUID": f"uuid{i}",
+                "category": "sponsor",
+                "locked": 1,
+            }
+        )
+    return {"segments": segments}
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:32} {seconds * 1e6:10.1f} us")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = random.Random(0)
+    response = make_response(count, rng)
+    print(f"{count} segments per video")
+    number = max(1, 20000 // count)
+    bench("process_segments (old)", lambda: old_process_segments(copy.deepcopy(response), 1), 1)
+    bench("process_segments", lambda: ApiHelper.process_segments(response, 1), number)
+    bench("deepcopy (included in old)", lambda: copy.deepcopy(response), number)
+    segments, _ = ApiHelper.process_segments(response, 1)
+    index = SegmentIndex(segments)
+    positions = [rng.uniform(0, count * 10) for _ in range(1000)]
+    bench(
+        "next_segment x1000 (linear)",
+        lambda: [old_next_segment(segments, p) for p in positions],
+        10,
+    )
+    bench("next_segment x1000 (bisect)", lambda: [index.next_segment(p) for p in positions], 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""AsyncConditionalTTL lookups, before and after monotonic deadlines and plain tuple keys.
+
+The old cache (async-cache KEY objects, datetime deadlines) is kept below as the
+reference. Both wrap a coroutine returning (value, ignore_ttl) like get_segments.
+
+    python benchmarks/bench_ttl_cache.py [calls]
+"""
+
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from cache.key import KEY  # noqa: E402
+
+from iSponsorBlockTV.cache_policies import create_policy  # noqa: E402
+from iSponsorBlockTV.conditional_ttl_cache import AsyncConditionalTTL  # noqa: E402
+
+VIDEOS = 1000  # Distinct keys, all cached before measuring hits
+
+
+class OldAsyncConditionalTTL:
+    class _TTL:
+        def __init__(self, time_to_live, maxsize, policy="lru"):
+            self.time_to_live = datetime.timedelta(seconds=time_to_live) if time_to_live else None
+
+            self.maxsize = maxsize
+            self.policy = create_policy(policy, maxsize)
+            self.data = {}
+
+        def __contains__(self, key):
+            if key not in self.data:
+                return False
+            key_expiration = self.data[key][1]
+            if key_expiration and key_expiration < datetime.datetime.now():
+                del self[key]
+                return False
+            return True
+
+        def __getitem__(self, key):
+            value = self.data[key][0]
+            self.policy.hit(key)
+            return value
+
+        def __setitem__(self, key, value):
+            value, ignore_ttl = value  # unpack tuple
+            ttl_value = (
+                (datetime.datetime.now() + self.time_to_live)
+                if (self.time_to_live and not ignore_ttl)
+                else None
+            )  # ignore ttl if ignore_ttl is True
+            self.data[key] = (value, ttl_value)
+            for evicted in self.policy.insert(key):
+                del self.data[evicted]
+
+        def __delitem__(self, key):
+            del self.data[key]
+            self.policy.remove(key)
+
+    def __init__(self, time_to_live=60, maxsize=1024, skip_args: int = 0, policy="lru"):
+        self.ttl = self._TTL(time_to_live=time_to_live, maxsize=maxsize, policy=policy)
+        self.skip_args = skip_args
+        self.pending = {}
+
+    async def _fill(self, key, coro):
+        try:
+            result = await coro
+            self.ttl[key] = result
+            return result[0]
+        finally:
+            del self.pending[key]
+
+    def __call__(self, func):
+        async def wrapper(*args, **kwargs):
+            key = KEY(args[self.skip_args :], kwargs)
+            if key in self.ttl:
+                return self.ttl[key]
+            future = self.pending.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._fill(key, func(*args, **kwargs)))
+                self.pending[key] = future
+            return await asyncio.shield(future)
+
+        return wrapper
+
+
+async def fetch(video_id):
+    return video_id, False
+
+
+async def bench(name, cache_class, calls):
+    cached = cache_class(time_to_live=300, maxsize=calls + VIDEOS)(fetch)
+    videos = [f"video{i}" for i in range(VIDEOS)]
+    for video_id in videos:
+        await cached(video_id)
+    start = time.perf_counter()
+    for i in range(calls):
+        await cached(videos[i % VIDEOS])
+    hit = (time.perf_counter() - start) / calls
+    start = time.perf_counter()
+    for i in range(calls):
+        await cached(f"new{i}")
+    miss = (time.perf_counter() - start) / calls
+    print(f"{name:6} hit {hit * 1e6:8.2f} us   miss+fill {miss * 1e6:8.2f} us")
+
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print(f"{calls} calls, {VIDEOS} cached videos")
+    await bench("old", OldAsyncConditionalTTL, calls)
+    await bench("new", AsyncConditionalTTL, calls)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
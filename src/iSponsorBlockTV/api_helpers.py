@@ -1,11 +1,21 @@
+import asyncio
 import html
+import os
 from hashlib import sha256
 
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientSession, ClientTimeout
 from cache import AsyncLRU
 
-from . import constants, dial_client
+from . import constants, dial_client, metrics
 from .conditional_ttl_cache import AsyncConditionalTTL
+from .mirror_index import MirrorIndex
+from .segment_mirror import SegmentMirror
+from .segment_store import SegmentStore
+from .segments import Segment, SegmentIndex
+
+
+class SegmentFetchError(Exception):
+    """SponsorBlock (or the segment cache server) answered with an error"""
 
 
 def list_to_tuple(function):
@@ -18,16 +28,62 @@ def list_to_tuple(function):
     return wrapper
 
 
+def sort_categories(function):
+    # The same categories in any order share one cache entry and one upstream fetch
+    def wrapper(vid_id_hashed, categories):
+        return function(vid_id_hashed, tuple(sorted(set(categories))))
+
+    return wrapper
+
+
 # Class that handles all the api calls and their cache
 class ApiHelper:
-    def __init__(self, config, web_session: ClientSession) -> None:
+    def __init__(self, config, web_session: ClientSession, skip_reporter=None) -> None:
         self.apikey = config.apikey
         self.skip_categories = config.skip_categories
         self.channel_whitelist = config.channel_whitelist
         self.skip_count_tracking = config.skip_count_tracking
+        self.skip_reporter = skip_reporter
         self.web_session = web_session
         self.num_devices = len(config.devices)
         self.minimum_skip_length = config.minimum_skip_length
+        # Another instance's cache server, tried before SponsorBlock
+        self.segment_cache_server = config.segment_cache_server
+        if self.segment_cache_server and not self.segment_cache_server.endswith("/"):
+            self.segment_cache_server += "/"
+        self.segment_mirror = None
+        if config.sponsorblock_mirror:
+            # The mmap'ed index is shared between processes, the SQLite mirror is the fallback
+            index_path = os.path.join(config.data_dir, constants.mirror_index_file)
+            if os.path.exists(index_path):
+                self.segment_mirror = MirrorIndex(index_path)
+            else:
+                self.segment_mirror = SegmentMirror(
+                    os.path.join(config.data_dir, constants.mirror_file)
+                )
+        self.segment_store = None
+        if config.persistent_segment_cache:
+            self.segment_store = SegmentStore(
+                os.path.join(config.data_dir, constants.segment_store_file),
+                time_to_live=config.segment_cache_ttl,
+            )
+        # Caches are created per instance so they can be sized from the config
+        self.segments_cache = AsyncConditionalTTL(
+            time_to_live=config.segment_cache_ttl,  # Only for non-locked segments
+            maxsize=config.segment_cache_size,
+            policy=config.segment_cache_policy,
+            max_stale=config.segment_cache_max_stale,
+        )
+        # Convert list to tuple so it can be used as a key in the cache
+        self.get_segments = list_to_tuple(self.segments_cache(self._get_segments))
+        # No stale-while-revalidate here, refreshing a video must see the current bucket
+        self.prefix_cache = AsyncConditionalTTL(
+            time_to_live=config.segment_cache_ttl,
+            maxsize=config.segment_cache_size,
+            policy=config.segment_cache_policy,
+        )
+        self.get_prefix_segments = sort_categories(self.prefix_cache(self._get_prefix_segments))
+        self.is_whitelisted = AsyncLRU(maxsize=config.whitelist_cache_size)(self._is_whitelisted)
 
     # Not used anymore, maybe it can stay here a little longer
     @AsyncLRU(maxsize=10)
@@ -49,8 +105,7 @@ class ApiHelper:
                 return i["id"]["videoId"], i["snippet"]["channelId"]
         return
 
-    @AsyncLRU(maxsize=100)
-    async def is_whitelisted(self, vid_id):
+    async def _is_whitelisted(self, vid_id):
         if self.apikey and self.channel_whitelist:
             channel_id = await self.__get_channel_id(vid_id)
             # check if channel id is in whitelist
@@ -108,101 +163,154 @@ class ApiHelper:
             channels.append((i["snippet"]["channelId"], i["snippet"]["channelTitle"], sub_count))
         return channels
 
-    @list_to_tuple  # Convert list to tuple so it can be used as a key in the cache
-    @AsyncConditionalTTL(time_to_live=300, maxsize=10)  # 5 minutes for non-locked segments
-    async def get_segments(self, vid_id):
+    async def _get_segments(self, vid_id):
         if not self.skip_categories:
-            return ([], True)  # Categories explicitly empty, skip segment fetching
+            return (SegmentIndex(), True)  # Categories explicitly empty, skip segment fetching
         if await self.is_whitelisted(vid_id):
             return (
-                [],
+                SegmentIndex(),
                 True,
-            )  # Return empty list and True to indicate
+            )  # Return no segments and True to indicate
             # that the cache should last forever
+        # The mirror is as fast as the store, used until it's imported
+        if self.segment_mirror and (video := self.segment_mirror.get(vid_id, self.skip_categories)):
+            return self.process_segments(video, self.minimum_skip_length)
+        store_params = self._segment_store_params()
+        if self.segment_store and (stored := self.segment_store.get(vid_id, store_params)):
+            return stored
         vid_id_hashed = sha256(vid_id.encode("utf-8")).hexdigest()[
             :4
         ]  # Hashes video id and gets the first 4 characters
+        # Errors are raised, not cached: a failed refresh keeps serving the stale segments
+        # and a failed miss is asked again on the next lookup
+        videos = await self.get_prefix_segments(vid_id_hashed, self.skip_categories)
+        response_json = videos.get(str(vid_id))
+        if response_json is None:
+            # No segments for this video (most videos), stored too so restarts don't ask
+            # again. Expires like unlocked segments, new submissions show up
+            segments, ignore_ttl = SegmentIndex(), False
+        else:
+            segments, ignore_ttl = self.process_segments(response_json, self.minimum_skip_length)
+        if self.segment_store:
+            self.segment_store.put(vid_id, segments, ignore_ttl, store_params)
+        return segments, ignore_ttl
+
+    async def _get_prefix_segments(self, vid_id_hashed, categories):
+        """Gets the segments of every video under a hash prefix, indexed by video id.
+        The whole response is cached so other videos in the same bucket
+        (playlists, autoplay) are served without another request.
+        Errors are raised so a failed bucket is never cached"""
         params = {
-            "category": self.skip_categories,
+            "category": list(categories),
             "actionType": constants.SponsorBlock_actiontype,
             "service": constants.SponsorBlock_service,
         }
+        if self.segment_cache_server:
+            try:
+                videos = await self._fetch_prefix_segments(
+                    self.segment_cache_server,
+                    vid_id_hashed,
+                    params,
+                    timeout=ClientTimeout(total=constants.segment_cache_server_timeout),
+                )
+            except (SegmentFetchError, ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(
+                    f"Segment cache server unavailable, using SponsorBlock: {e or type(e).__name__}"
+                )
+                metrics.segment_cache_server_fallbacks.inc()
+            else:
+                # Unlike single videos, a bucket always expires, new videos can show up in it
+                return videos, False
+        return await self._fetch_prefix_segments(
+            constants.SponsorBlock_api, vid_id_hashed, params
+        ), False
+
+    async def _fetch_prefix_segments(self, api_url, vid_id_hashed, params, timeout=None):
         headers = {"Accept": "application/json"}
-        url = constants.SponsorBlock_api + "skipSegments/" + vid_id_hashed
-        async with self.web_session.get(url, headers=headers, params=params) as response:
+        url = api_url + "skipSegments/" + vid_id_hashed
+        kwargs = {"timeout": timeout} if timeout else {}
+        async with self.web_session.get(url, headers=headers, params=params, **kwargs) as response:
+            if response.status == 404:
+                return {}  # No video in this bucket has segments
+            if response.status != 200:
+                response_text = await response.text()
+                print(
+                    f"Error getting segments for hash prefix {vid_id_hashed} from {api_url}."
+                    f" Code: {response.status} - {response_text}"
+                )
+                raise SegmentFetchError(f"{api_url} answered {response.status}")
             response_json = await response.json()
-        if response.status != 200:
-            response_text = await response.text()
-            print(
-                f"Error getting segments for video {vid_id}, hashed as {vid_id_hashed}."
-                f" Code: {response.status} - {response_text}"
-            )
-            return [], True
-        for i in response_json:
-            if str(i["videoID"]) == str(vid_id):
-                response_json = i
-                break
-        return self.process_segments(response_json, self.minimum_skip_length)
+        return {str(i["videoID"]): i for i in response_json}
+
+    def _segment_store_params(self):
+        # Stored segments depend on the categories and minimum length they were processed with
+        return f"{','.join(sorted(self.skip_categories))};{self.minimum_skip_length}"
 
     @staticmethod
     def process_segments(response, minimum_skip_length):
         segments = []
         ignore_ttl = True
         try:
-            response_segments = response["segments"]
-            # sort by end
-            response_segments.sort(key=lambda x: x["segment"][1])
-            # extend ends of overlapping segments to make one big segment
-            for i in response_segments:
-                for j in response_segments:
-                    if j["segment"][0] <= i["segment"][1] <= j["segment"][1]:
-                        i["segment"][1] = j["segment"][1]
-
-            # sort by start
-            response_segments.sort(key=lambda x: x["segment"][0])
-            # extend starts of overlapping segments to make one big segment
-            for i in reversed(response_segments):
-                for j in reversed(response_segments):
-                    if j["segment"][0] <= i["segment"][0] <= j["segment"][1]:
-                        i["segment"][0] = j["segment"][0]
-
+            # Sort once by start, everything else is a single sweep (the response isn't modified)
+            response_segments = sorted(response["segments"], key=lambda x: x["segment"][0])
             for i in response_segments:
                 ignore_ttl = (
                     ignore_ttl and i["locked"] == 1
                 )  # If all segments are locked, ignore ttl
-                segment = i["segment"]
-                UUID = i["UUID"]
-                segment_dict = {"start": segment[0], "end": segment[1], "UUID": [UUID]}
-                try:
-                    # Get segment before to check if they are too close to each other
-                    segment_before_end = segments[-1]["end"]
-                    segment_before_start = segments[-1]["start"]
-                    segment_before_UUID = segments[-1]["UUID"]
-
-                except IndexError:
-                    segment_before_end = -10
-                if (
-                    segment_dict["start"] - segment_before_end < 1
-                ):  # Less than 1 second apart, combine them and skip them together
-                    segment_dict["start"] = segment_before_start
-                    segment_dict["UUID"].extend(segment_before_UUID)
-                    segments.pop()
+            for segment in ApiHelper._merge_overlapping(response_segments):
+                # Less than 1 second apart from the last segment kept, combine them and
+                # skip them together
+                if segments and segment.start - segments[-1].end < 1:
+                    segment_before = segments.pop()
+                    segment = Segment(
+                        segment_before.start,
+                        max(segment.end, segment_before.end),
+                        segment_before.uuids + segment.uuids,
+                        segment_before.category,
+                        segment_before.locked and segment.locked,
+                    )
                 # Only add segments greater than minimum skip length
-                if segment_dict["end"] - segment_dict["start"] > minimum_skip_length:
-                    segments.append(segment_dict)
+                if segment.end - segment.start > minimum_skip_length:
+                    segments.append(segment)
         except BaseException:
             pass
-        return segments, ignore_ttl
+        return SegmentIndex(segments), ignore_ttl
+
+    @staticmethod
+    def _merge_overlapping(sorted_segments):
+        """Yields a Segment for each group of overlapping segments,
+        sorted_segments has to be sorted by start"""
+        group = []
+        end = None
+        for i in sorted_segments:
+            if group and i["segment"][0] <= end:
+                end = max(end, i["segment"][1])
+                group.append(i)
+                continue
+            if group:
+                yield ApiHelper._group_to_segment(group, end)
+            group = [i]
+            end = i["segment"][1]
+        if group:
+            yield ApiHelper._group_to_segment(group, end)
+
+    @staticmethod
+    def _group_to_segment(group, end):
+        return Segment(
+            group[0]["segment"][0],
+            end,
+            tuple(i["UUID"] for i in group),
+            group[0].get("category", ""),
+            all(i.get("locked") == 1 for i in group),
+        )
 
-    async def mark_viewed_segments(self, uuids):
+    def mark_viewed_segments(self, uuids):
         """Marks the segments as viewed in the SponsorBlock API
         if skip_count_tracking is enabled.
-        Lets the contributor know that someone skipped the segment (thanks)"""
-        if self.skip_count_tracking:
-            for i in uuids:
-                url = constants.SponsorBlock_api + "viewedVideoSponsorTime/"
-                params = {"UUID": i}
-                await self.web_session.post(url, params=params)
+        Lets the contributor know that someone skipped the segment (thanks).
+        Queued and sent in the background, never delays a skip"""
+        if self.skip_count_tracking and self.skip_reporter:
+            self.skip_reporter.report(uuids)
 
     async def discover_youtube_devices_dial(self):
         """Discovers YouTube devices using DIAL"""
@@ -0,0 +1,167 @@
+from collections import OrderedDict, defaultdict
+
+# Eviction policies used by AsyncConditionalTTL.
+# They only track keys, the cache itself stores the values.
+# hit() is called on every cache hit, insert() when a new key is stored (returns the
+# keys that have to be evicted to make room) and remove() when a key is dropped by the cache
+
+
+class LRUPolicy:
+    """Evicts the least recently used key"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.order = OrderedDict()
+
+    def hit(self, key):
+        self.order.move_to_end(key)
+
+    def insert(self, key):
+        if key in self.order:
+            self.hit(key)
+            return []
+        self.order[key] = None
+        evicted = []
+        while self.maxsize and len(self.order) > self.maxsize:
+            evicted.append(self.order.popitem(last=False)[0])
+        return evicted
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+
+class LFUPolicy:
+    """Evicts the least frequently used key, the oldest one on ties"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.freq = {}
+        self.buckets = defaultdict(OrderedDict)  # frequency -> keys, oldest first
+        self.min_freq = 0
+
+    def _unlink(self, key, freq):
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[freq]
+
+    def hit(self, key):
+        freq = self.freq[key]
+        self._unlink(key, freq)
+        if self.min_freq == freq and freq not in self.buckets:
+            self.min_freq = freq + 1
+        self.freq[key] = freq + 1
+        self.buckets[freq + 1][key] = None
+
+    def insert(self, key):
+        if key in self.freq:
+            self.hit(key)
+            return []
+        evicted = []
+        if self.maxsize and len(self.freq) >= self.maxsize:
+            oldest = next(iter(self.buckets[self.min_freq]))
+            self._unlink(oldest, self.min_freq)
+            del self.freq[oldest]
+            evicted.append(oldest)
+        self.freq[key] = 1
+        self.buckets[1][key] = None
+        self.min_freq = 1
+        return evicted
+
+    def remove(self, key):
+        freq = self.freq.pop(key, None)
+        if freq is None:
+            return
+        self._unlink(key, freq)
+        if self.min_freq == freq and freq not in self.buckets:
+            self.min_freq = min(self.buckets, default=0)
+
+
+class ARCPolicy:
+    """Adaptive Replacement Cache (Megiddo & Modha).
+    Balances recency (t1) and frequency (t2) using ghost lists of
+    recently evicted keys (b1, b2) to adapt the target size of t1 (p)"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def hit(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            self.t2.move_to_end(key)
+
+    def _replace(self, in_b2):
+        if self.t1 and (len(self.t1) > self.p or (in_b2 and len(self.t1) == self.p) or not self.t2):
+            key = self.t1.popitem(last=False)[0]
+            self.b1[key] = None
+        else:
+            key = self.t2.popitem(last=False)[0]
+            self.b2[key] = None
+        return key
+
+    def _full(self):
+        return len(self.t1) + len(self.t2) >= self.maxsize
+
+    def insert(self, key):
+        if key in self.t1 or key in self.t2:
+            self.hit(key)
+            return []
+        evicted = []
+        if key in self.b1:
+            self.p = min(self.maxsize, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            if self._full():
+                evicted.append(self._replace(False))
+            self.t2[key] = None
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            if self._full():
+                evicted.append(self._replace(True))
+            self.t2[key] = None
+        else:
+            l1 = len(self.t1) + len(self.b1)
+            total = l1 + len(self.t2) + len(self.b2)
+            if l1 >= self.maxsize:
+                if self.b1:
+                    self.b1.popitem(last=False)
+                    if self._full():
+                        evicted.append(self._replace(False))
+                else:
+                    evicted.append(self.t1.popitem(last=False)[0])
+            elif total >= self.maxsize:
+                if total >= 2 * self.maxsize:
+                    self.b2.popitem(last=False)
+                if self._full():
+                    evicted.append(self._replace(False))
+            self.t1[key] = None
+        return evicted
+
+    def remove(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+
+
+policies = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "arc": ARCPolicy,
+}
+
+
+def create_policy(name, maxsize):
+    if not maxsize:
+        return LRUPolicy(maxsize)  # Unlimited size, nothing is ever evicted
+    try:
+        return policies[name.lower()](maxsize)
+    except KeyError:
+        raise ValueError(
+            f"Unknown cache policy {name}, expected one of: {', '.join(policies)}"
+        ) from None
@@ -0,0 +1,36 @@
+import asyncio
+import re
+
+from aiohttp import ClientError, web
+
+from .api_helpers import SegmentFetchError
+
+# SponsorBlock accepts 4 to 32 characters of the sha256 of the video id
+PREFIX = re.compile(r"^[0-9a-f]{4,32}$")
+
+
+async def start_server(api_helper, host, port):
+    """Serves SponsorBlock's skipSegments/{prefix} endpoint from api_helper's prefix cache
+    so other instances can use http://host:port/api/ as their segment_cache_server.
+    Misses are fetched from SponsorBlock (or this instance's own cache server).
+    Returns the runner to clean it up"""
+
+    async def handle_skip_segments(request):
+        prefix = request.match_info["prefix"].lower()
+        if not PREFIX.match(prefix):
+            raise web.HTTPBadRequest(text="Invalid hash prefix")
+        categories = request.query.getall("category", ()) or api_helper.skip_categories
+        try:
+            videos = await api_helper.get_prefix_segments(prefix, categories)
+        except (SegmentFetchError, ClientError, asyncio.TimeoutError):
+            raise web.HTTPBadGateway(text="Error getting segments from SponsorBlock") from None
+        if not videos:
+            raise web.HTTPNotFound(text="Not Found")  # Same as SponsorBlock
+        return web.json_response(list(videos.values()))
+
+    app = web.Application()
+    app.router.add_get("/api/skipSegments/{prefix}", handle_skip_segments)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
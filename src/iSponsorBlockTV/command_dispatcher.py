@@ -0,0 +1,119 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from . import metrics
+
+# Lower goes first. Skips can't wait behind anything, muting an ad and asking for the
+# position (to time a skip) come next, the rest can wait
+PRIORITIES = {
+    "seekTo": 0,
+    "skipAd": 0,
+    "setVolume": 1,
+    "getNowPlaying": 1,
+}
+DEFAULT_PRIORITY = 2
+# Only the latest of these matters, a queued one is updated instead of sending both
+# (e.g. mute then unmute while an ad starts and ends)
+COALESCED = {"setVolume", "getNowPlaying", "setAutoplayMode"}
+
+
+class _Command:
+    __slots__ = ("command", "parameters", "priority", "futures", "queued_at", "sent")
+
+    def __init__(self, command, parameters, priority, queued_at):
+        self.command = command
+        self.parameters = parameters
+        self.priority = priority
+        self.futures = []
+        self.queued_at = queued_at
+        self.sent = False
+
+
+class CommandDispatcher:
+    """Sends a device's lounge commands one at a time (they're numbered, they can't
+    overlap) in priority order instead of arrival order, so a skip never waits behind
+    volume or autoplay commands. Queued commands in COALESCED are merged with newer
+    ones of the same kind, every caller gets the result of the one that was sent"""
+
+    def __init__(self, send, logger, name=None):
+        self.send = send  # Coroutine function (command, parameters) sending one command
+        self.logger = logger
+        self.name = name
+        self.heap = []  # (priority, order, command), a command can be in it twice
+        self.queued = {}  # Coalesced commands waiting to be sent, by name
+        self.order = itertools.count()
+        self.task = None
+
+    def submit(self, command, parameters=None):
+        """Queues a command, returns a future with the result of sending it"""
+        priority = PRIORITIES.get(command, DEFAULT_PRIORITY)
+        entry = self.queued.get(command)
+        if entry is not None:
+            entry.parameters = parameters
+            metrics.lounge_commands_coalesced.inc(device=self.name, command=command)
+            if priority < entry.priority:
+                entry.priority = priority
+                heapq.heappush(self.heap, (priority, next(self.order), entry))
+        else:
+            entry = _Command(command, parameters, priority, time.monotonic())
+            if command in COALESCED:
+                self.queued[command] = entry
+            heapq.heappush(self.heap, (priority, next(self.order), entry))
+        future = asyncio.get_running_loop().create_future()
+        entry.futures.append(future)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self.heap:
+            _, _, entry = heapq.heappop(self.heap)
+            if entry.sent:
+                continue  # Already sent from a higher priority spot
+            entry.sent = True
+            if self.queued.get(entry.command) is entry:
+                del self.queued[entry.command]
+            if all(future.done() for future in entry.futures):
+                continue  # Every caller gave up on it
+            start = time.monotonic()
+            metrics.lounge_command_wait.observe(
+                start - entry.queued_at, device=self.name, command=entry.command
+            )
+            try:
+                result = await self.send(entry.command, entry.parameters)
+            except asyncio.CancelledError:
+                self._fail(entry, None)
+                raise
+            except Exception as e:
+                self._fail(entry, e)
+                continue
+            finally:
+                metrics.lounge_command_duration.observe(
+                    time.monotonic() - start, device=self.name, command=entry.command
+                )
+            for future in entry.futures:
+                if not future.done():
+                    future.set_result(result)
+
+    @staticmethod
+    def _fail(entry, exception):
+        for future in entry.futures:
+            if future.done():
+                continue
+            if exception is None:
+                future.cancel()
+            else:
+                future.set_exception(exception)
+
+    def cancel(self):
+        """Drops the queued commands, returns the task to be awaited"""
+        for _, _, entry in self.heap:
+            self._fail(entry, None)
+        self.heap.clear()
+        self.queued.clear()
+        if self.task is None:
+            return []
+        self.task.cancel()
+        return [self.task]
@@ -1,7 +1,8 @@
-import datetime
+import asyncio
+from heapq import heappop, heappush
+from time import monotonic
 
-from cache.key import KEY
-from cache.lru import LRU
+from .cache_policies import create_policy
 
 # MIT License
 
@@ -29,56 +30,159 @@ from cache.lru import LRU
 
 
 class AsyncConditionalTTL:
-    class _TTL(LRU):
-        def __init__(self, time_to_live, maxsize):
-            super().__init__(maxsize=maxsize)
+    class _Entry:
+        __slots__ = ("value", "expires_at", "purge_at")
 
-            self.time_to_live = datetime.timedelta(seconds=time_to_live) if time_to_live else None
+        # time.monotonic() deadlines, None = never expires
+        def __init__(self, value, expires_at, purge_at):
+            self.value = value
+            self.expires_at = expires_at  # Stale after this
+            self.purge_at = purge_at  # Can't be served at all after this
 
-            self.maxsize = maxsize
+    class _TTL:
+        def __init__(self, time_to_live, maxsize, policy="lru", max_stale=0):
+            self.time_to_live = time_to_live or None
+            self.max_stale = max_stale or 0
 
-        def __contains__(self, key):
-            if key not in self.keys():
-                return False
-            key_expiration = super().__getitem__(key)[1]
-            if key_expiration and key_expiration < datetime.datetime.now():
+            self.maxsize = maxsize
+            self.policy = create_policy(policy, maxsize)
+            self.data = {}
+            # (purge_at, seq, key, entry) min-heap, outdated items are skipped when popped
+            self.expiry_heap = []
+            self.seq = 0
+            self.evictions = 0
+            self.expirations = 0
+
+        def __len__(self):
+            return len(self.data)
+
+        def get(self, key):
+            """Returns the entry for key or None if it's missing or past its stale window"""
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            if entry.purge_at is not None and entry.purge_at <= monotonic():
                 del self[key]
-                return False
-            return True
-
-        def __getitem__(self, key):
-            value = super().__getitem__(key)[0]
-            return value
+                self.expirations += 1
+                return None
+            self.policy.hit(key)
+            return entry
 
         def __setitem__(self, key, value):
             value, ignore_ttl = value  # unpack tuple
-            ttl_value = (
-                (datetime.datetime.now() + self.time_to_live)
-                if (self.time_to_live and not ignore_ttl)
-                else None
-            )  # ignore ttl if ignore_ttl is True
-            super().__setitem__(key, (value, ttl_value))
-
-    def __init__(self, time_to_live=60, maxsize=1024, skip_args: int = 0):
+            now = monotonic()
+            self._purge_expired(now)
+            if self.time_to_live and not ignore_ttl:
+                expires_at = now + self.time_to_live
+                entry = AsyncConditionalTTL._Entry(value, expires_at, expires_at + self.max_stale)
+                self.seq += 1
+                heappush(self.expiry_heap, (entry.purge_at, self.seq, key, entry))
+            else:  # ignore ttl if ignore_ttl is True
+                entry = AsyncConditionalTTL._Entry(value, None, None)
+            self.data[key] = entry
+            for evicted in self.policy.insert(key):
+                del self.data[evicted]
+                self.evictions += 1
+
+        def __delitem__(self, key):
+            del self.data[key]
+            self.policy.remove(key)
+
+        def _purge_expired(self, now):
+            heap = self.expiry_heap
+            while heap and heap[0][0] <= now:
+                _, _, key, entry = heappop(heap)
+                # Skip entries that have been replaced or evicted since they were pushed
+                if self.data.get(key) is entry:
+                    del self[key]
+                    self.expirations += 1
+
+    def __init__(
+        self,
+        time_to_live=60,
+        maxsize=1024,
+        skip_args: int = 0,
+        policy="lru",
+        max_stale=0,
+    ):
         """
 
         :param time_to_live: Use time_to_live as None for non expiring cache
         :param maxsize: Use maxsize as None for unlimited size cache
         :param skip_args: Use `1` to skip first arg of func in determining cache key
+        :param policy: Eviction policy used once maxsize is reached: lru, lfu or arc
+        :param max_stale: Seconds an expired value keeps being served while it's
+        refreshed in the background (stale-while-revalidate). Use 0 to disable
         """
-        self.ttl = self._TTL(time_to_live=time_to_live, maxsize=maxsize)
+        self.ttl = self._TTL(
+            time_to_live=time_to_live, maxsize=maxsize, policy=policy, max_stale=max_stale
+        )
         self.skip_args = skip_args
+        self.pending = {}  # In-flight calls, shared by concurrent callers with the same key
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0  # Misses that waited on an in-flight call instead of making their own
+        self.refresh_errors = 0
+
+    def stats(self):
+        return {
+            "size": len(self.ttl),
+            "maxsize": self.ttl.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.ttl.evictions,
+            "expirations": self.ttl.expirations,
+            "refresh_errors": self.refresh_errors,
+        }
+
+    async def _fill(self, key, coro):
+        try:
+            result = await coro
+            self.ttl[key] = result
+            return result[0]
+        finally:
+            del self.pending[key]
+
+    def _refresh_done(self, future):
+        # Nobody awaits background refreshes, retrieve the error so it isn't reported as
+        # never retrieved. The stale value keeps being served until the next attempt
+        if not future.cancelled() and future.exception() is not None:
+            self.refresh_errors += 1
 
     def __call__(self, func):
         async def wrapper(*args, **kwargs):
-            key = KEY(args[self.skip_args :], kwargs)
-            if key in self.ttl:
-                val = self.ttl[key]
+            # Arguments must be hashable, plain tuples are much cheaper to hash than KEY objects
+            key = args[self.skip_args :]
+            if kwargs:
+                key += (frozenset(kwargs.items()),)
+            entry = self.ttl.get(key)
+            if entry is not None:
+                if (
+                    self.ttl.max_stale
+                    and entry.expires_at is not None
+                    and entry.expires_at <= monotonic()
+                ):
+                    # Serve the stale value right away and refresh it in the background
+                    self.stale_hits += 1
+                    if key not in self.pending:
+                        future = asyncio.ensure_future(self._fill(key, func(*args, **kwargs)))
+                        future.add_done_callback(self._refresh_done)
+                        self.pending[key] = future
+                else:
+                    self.hits += 1
+                return entry.value
+            future = self.pending.get(key)
+            if future is None:
+                self.misses += 1
+                future = asyncio.ensure_future(self._fill(key, func(*args, **kwargs)))
+                self.pending[key] = future
             else:
-                self.ttl[key] = await func(*args, **kwargs)
-                val = self.ttl[key]
-
-            return val
+                self.coalesced += 1
+            # Shielded so a cancelled caller doesn't cancel the call for everyone else
+            return await asyncio.shield(future)
 
         wrapper.__name__ += func.__name__
 
@@ -2,7 +2,7 @@ import asyncio
 
 import aiohttp
 
-from . import api_helpers, ytlounge
+from . import api_helpers, event_loop, ytlounge
 
 # Constants for user input prompts
 USE_PROXY_PROMPT = "Do you want to use system-wide proxy? (y/N)"
@@ -80,7 +80,7 @@ def main(config, debug: bool) -> None:
     choice = get_yn_input(USE_PROXY_PROMPT)
     config.use_proxy = choice == "y"
 
-    loop = asyncio.get_event_loop_policy().get_event_loop()
+    loop = event_loop.new_event_loop(config.event_loop)
     web_session = loop.run_until_complete(create_web_session(config.use_proxy))
     if debug:
         loop.set_debug(True)
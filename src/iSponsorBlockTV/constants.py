@@ -3,6 +3,7 @@ SponsorBlock_service = "youtube"
 SponsorBlock_actiontype = "skip"
 
 SponsorBlock_api = "https://sponsor.ajay.app/api/"
+SponsorBlock_dump_url = "https://sponsor.ajay.app/database/sponsorTimes.csv"
 Youtube_api = "https://www.googleapis.com/youtube/v3/"
 
 skip_categories = (
@@ -21,6 +22,13 @@ skip_categories = (
 youtube_client_blacklist = ["TVHTML5_FOR_KIDS"]
 
 
+segment_store_file = "segment_cache.sqlite3"
+latency_file = "latency_{}.json"  # Formatted with the screen id
+mirror_file = "sponsorblock_mirror.sqlite3"
+mirror_index_file = "sponsorblock_mirror.idx"
+skip_reports_file = "skip_reports.json"
+segment_cache_server_timeout = 2  # Seconds before falling back to SponsorBlock
+
 config_file_blacklist_keys = ["config_file", "data_dir"]
 
 github_wiki_base_url = "https://github.com/dmunozv04/iSponsorBlockTV/wiki"
@@ -1,25 +1,154 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+
+import aiohttp
+
+
 class AiohttpTracer:
-    def __init__(self, logger):
+    """Structured HTTP tracing.
+    Records the timing phases (queue, DNS, connect, time to first byte, total), status and
+    size of a sample of the requests. The records are kept in a ring buffer, optionally
+    appended to a JSONL file and logged at debug level.
+    Query strings are dropped from the recorded URLs (they hold API keys and lounge tokens).
+    Bodies are only captured if body_bytes is set, truncated to that many bytes.
+    Responses closed before their end are recorded with what was received"""
+
+    def __init__(self, logger, sample_rate=1.0, buffer_size=1000, path=None, body_bytes=0):
         self.logger = logger
+        self.sample_rate = sample_rate
+        self.body_bytes = body_bytes
+        self.records = deque(maxlen=buffer_size)
+        self.file = open(path, "a", encoding="utf-8", buffering=1) if path else None
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_connection_queued_start.append(self.on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self.on_connection_queued_end)
+        trace_config.on_connection_create_start.append(self.on_connection_create_start)
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        trace_config.on_dns_resolvehost_start.append(self.on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(self.on_dns_resolvehost_end)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_exception)
+        if self.body_bytes:
+            # Not registered otherwise, so bodies cost nothing unless asked for
+            trace_config.on_response_chunk_received.append(self.on_response_chunk_received)
+        return trace_config
 
+    # Unsampled requests only pay for the random() call and the early returns
     async def on_request_start(self, session, context, params):
-        self.logger.debug(f"Request started ({id(context):#x}): {params.method} {params.url}")
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            context.record = None
+            return
+        context.start = time.monotonic()
+        context.record = {
+            "time": time.time(),
+            "method": params.method,
+            "url": str(params.url.with_query(None)),
+            "status": None,
+            "reused": False,
+            "queue": None,
+            "dns": None,
+            "connect": None,
+            "ttfb": None,
+            "total": None,
+            "bytes": None,
+        }
+
+    def _elapsed(self, context):
+        return round(time.monotonic() - context.start, 6)
+
+    async def on_connection_queued_start(self, session, context, params):
+        if context.record is not None:
+            context.phase_start = time.monotonic()
+
+    async def on_connection_queued_end(self, session, context, params):
+        if context.record is not None:
+            context.record["queue"] = round(time.monotonic() - context.phase_start, 6)
+
+    async def on_connection_create_start(self, session, context, params):
+        if context.record is not None:
+            context.phase_start = time.monotonic()
+
+    async def on_connection_create_end(self, session, context, params):
+        # Includes DNS, the connection was created after it
+        if context.record is not None:
+            context.record["connect"] = round(time.monotonic() - context.phase_start, 6)
+
+    async def on_connection_reuseconn(self, session, context, params):
+        if context.record is not None:
+            context.record["reused"] = True
+
+    async def on_dns_resolvehost_start(self, session, context, params):
+        if context.record is not None:
+            context.dns_start = time.monotonic()
+
+    async def on_dns_resolvehost_end(self, session, context, params):
+        if context.record is not None:
+            context.record["dns"] = round(time.monotonic() - context.dns_start, 6)
 
     async def on_request_end(self, session, context, params):
-        self.logger.debug(f"Request ended ({id(context):#x}): {params.response.status}")
+        record = context.record
+        if record is None:
+            return
+        record["ttfb"] = self._elapsed(context)
+        record["status"] = params.response.status
+        content = params.response.content
+        loop = asyncio.get_running_loop()
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if not finished:
+                finished = True
+                self._finish(record)
+
+        def on_end():
+            # The end of the body or the connection being released, whichever comes first.
+            # Responses closed before their end (rotated lounge polls) never reach EOF
+            if record["total"] is None:
+                record["total"] = self._elapsed(context)
+                record["bytes"] = content.total_bytes
+            # Deferred so a body read right after the end of the stream is captured first
+            loop.call_soon(finish)
+
+        content.on_eof(on_end)
+        connection = params.response.connection
+        if connection is not None:
+            connection.add_callback(on_end)
 
     async def on_request_exception(self, session, context, params):
-        self.logger.debug(f"Request exception ({id(context):#x}): {params.exception}")
+        record = context.record
+        if record is None:
+            return
+        record["total"] = self._elapsed(context)
+        record["error"] = repr(params.exception)
+        self._finish(record)
 
     async def on_response_chunk_received(self, session, context, params):
-        chunk_size = len(params.chunk)
-        try:
-            # Try to decode as text
-            text = params.chunk.decode("utf-8")
-            self.logger.debug(f"Response chunk ({id(context):#x}) {chunk_size} bytes: {text}")
-        except UnicodeDecodeError:
-            # If not valid UTF-8, show as hex
-            hex_data = params.chunk.hex()
-            self.logger.debug(
-                f"Response chunk ({id(context):#x}) ({chunk_size} bytes) [HEX]: {hex_data}"
-            )
+        if context.record is None:
+            return
+        body = getattr(context, "body", b"")
+        if len(body) < self.body_bytes:
+            # The first body_bytes of the body, whatever the chunks it came in
+            context.body = body = body + params.chunk[: self.body_bytes - len(body)]
+            context.record["body"] = body.decode("utf-8", "replace")
+
+    def _finish(self, record):
+        self.records.append(record)
+        if self.file or self.logger.isEnabledFor(logging.DEBUG):
+            line = json.dumps(record, separators=(",", ":"))
+            if self.file:
+                self.file.write(line + "\n")
+            self.logger.debug("%s", line)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
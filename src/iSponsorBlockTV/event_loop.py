@@ -0,0 +1,54 @@
+import asyncio
+import sys
+
+# auto uses uvloop when it's installed and the standard asyncio loop otherwise
+LOOPS = ("auto", "asyncio", "uvloop")
+
+
+def _uvloop():
+    try:
+        import uvloop
+    except ImportError:  # Not installed or not supported (Windows)
+        return None
+    return uvloop
+
+
+def loop_factory(name="auto"):
+    """Returns the function that creates the event loops for the chosen backend"""
+    if name not in LOOPS:
+        raise ValueError(f"Unknown event loop {name}, expected one of: {', '.join(LOOPS)}")
+    if name == "asyncio":
+        return asyncio.new_event_loop
+    uvloop = _uvloop()
+    if uvloop is None:
+        if name == "uvloop":
+            raise ValueError("event_loop is set to uvloop but uvloop isn't installed")
+        return asyncio.new_event_loop
+    return uvloop.new_event_loop
+
+
+def new_event_loop(name="auto"):
+    return loop_factory(name)()
+
+
+def run(coro, name="auto"):
+    """asyncio.run() on the chosen event loop"""
+    factory = loop_factory(name)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(coro)
+    # asyncio.run() can't take a loop before 3.11, set it as the current one instead
+    loop = factory()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
@@ -1,14 +1,25 @@
+import io
 import json
 import logging
 import os
 import sys
 import time
+import urllib.request
 
 import rich_click as click
 from appdirs import user_data_dir
 
-from . import config_setup, main, setup_wizard
-from .constants import config_file_blacklist_keys, github_wiki_base_url
+from . import cache_policies, config_setup, event_loop, main, setup_wizard
+from .constants import (
+    SponsorBlock_dump_url,
+    config_file_blacklist_keys,
+    github_wiki_base_url,
+    mirror_file,
+    mirror_index_file,
+    userAgent,
+)
+from .mirror_index import write_index
+from .segment_mirror import MirrorImportError, SegmentMirror
 
 
 class Device:
@@ -52,8 +63,56 @@ class Config:
         self.skip_ads = False
         self.minimum_skip_length = 1
         self.auto_play = True
+        # Replace lounge polls just before the server ends them, instead of right after
+        self.lounge_poll_rotation = True
         self.join_name = "iSponsorBlockTV"
         self.use_proxy = False
+        # Connections to SponsorBlock and the YouTube Data API, in total and per host
+        self.http_pool_size = 20
+        self.http_pool_per_host = 10
+        # Connections reserved for the lounge (API calls never use them), 0 for 3 per device
+        self.lounge_pool_size = 0
+        self.http_keepalive_timeout = 30  # Seconds idle connections are kept open
+        self.persistent_segment_cache = True
+        self.segment_cache_size = 100
+        self.segment_cache_ttl = 300  # Seconds, locked segments never expire
+        self.segment_cache_policy = "lru"  # lru, lfu or arc
+        # Seconds expired segments are still served while they're refreshed, 0 to disable
+        self.segment_cache_max_stale = 86400
+        self.whitelist_cache_size = 100
+        # Videos of the lounge queue to get the segments of ahead of time
+        self.prefetch_depth = 3
+        # Look segments up in a local copy of SponsorBlock's database (see import-mirror)
+        self.sponsorblock_mirror = False
+        # Serve the segment cache to other instances on http://host:port/api/, 0 to disable
+        self.cache_server_port = 0
+        self.cache_server_host = "127.0.0.1"  # 0.0.0.0 to serve the whole LAN
+        # Another instance's cache server (http://host:port/api/) to ask before SponsorBlock
+        self.segment_cache_server = ""
+        # Learn each device's latency and use it instead of its offset (off by default,
+        # it replaces offsets tuned by hand)
+        self.auto_offset = False
+        self.skip_accuracy_window = 50  # Milliseconds
+        # Seconds, ask the device for its position before skipping and while waiting for a
+        # skip to correct drift. 0 to disable
+        self.skip_resync_lead = 3
+        self.skip_resync_interval = 60
+        # Prometheus metrics endpoint (http://metrics_host:metrics_port/metrics), 0 to disable
+        self.metrics_port = 0
+        self.metrics_host = "127.0.0.1"
+        self.event_loop = "auto"  # auto (uvloop if installed), asyncio or uvloop
+        # Processes to split the devices between, 0 for one per CPU core
+        # (metrics_port is incremented for each one)
+        self.shards = 1
+        # Seconds between event loop delay samples, 0 to disable
+        self.loop_monitor_interval = 0.5
+        # Milliseconds the loop can be blocked for before the culprit is logged
+        self.slow_callback_threshold = 100
+        # Used with --http-tracing
+        self.http_trace_sample_rate = 1.0  # Share of the requests that are traced
+        self.http_trace_buffer_size = 1000  # Latest traced requests kept in memory
+        self.http_trace_file = ""  # JSONL file (in the data dir) to append them to
+        self.http_trace_body_bytes = 0  # Bytes of each response body to record, 0 to disable
         self.__load()
 
     def validate(self):
@@ -80,6 +139,12 @@ class Config:
         if self.skip_categories is None:
             self.skip_categories = ["sponsor"]
             print("No categories found, using default: sponsor")
+        if self.segment_cache_policy.lower() not in cache_policies.policies:
+            raise ValueError(
+                f"Invalid segment_cache_policy {self.segment_cache_policy}, "
+                f"expected one of: {', '.join(cache_policies.policies)}"
+            )
+        event_loop.loop_factory(self.event_loop)  # Raises if unknown or not installed
 
     def __load(self):
         try:
@@ -143,7 +208,17 @@ class Config:
     help="data directory",
 )
 @click.option("--debug", is_flag=True, help="debug mode")
-@click.option("--http-tracing", is_flag=True, help="Enable HTTP request/response tracing")
+@click.option(
+    "--event-loop",
+    "event_loop_name",
+    type=click.Choice(event_loop.LOOPS),
+    help="Event loop to use, overrides the event_loop config option",
+)
+@click.option(
+    "--http-tracing",
+    is_flag=True,
+    help="Record timings of HTTP requests (logged in debug mode, see the http_trace_* options)",
+)
 # legacy commands as arguments
 @click.option("--setup", is_flag=True, help="Setup the program graphically", hidden=True)
 @click.option(
@@ -153,11 +228,12 @@ class Config:
     hidden=True,
 )
 @click.pass_context
-def cli(ctx, data, debug, http_tracing, setup, setup_cli):
+def cli(ctx, data, debug, event_loop_name, http_tracing, setup, setup_cli):
     """iSponsorblockTV"""
     ctx.ensure_object(dict)
     ctx.obj["data_dir"] = data
     ctx.obj["debug"] = debug
+    ctx.obj["event_loop"] = event_loop_name
     ctx.obj["http_tracing"] = http_tracing
 
     logger = logging.getLogger()
@@ -219,10 +295,47 @@ def setup_cli_command(ctx):
 def start(ctx):
     """Start the main program"""
     config = Config(ctx.obj["data_dir"])
+    if ctx.obj["event_loop"]:
+        config.event_loop = ctx.obj["event_loop"]
     config.validate()
     main.main(config, ctx.obj["debug"], ctx.obj["http_tracing"])
 
 
+@cli.command(name="import-mirror")
+@click.argument("source", default=SponsorBlock_dump_url)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Remove the segments missing from the dump even if it's much smaller than the mirror",
+)
+@click.pass_context
+def import_mirror(ctx, source, force):
+    """Create or update the local SponsorBlock mirror from a sponsorTimes.csv dump
+    (a file or URL, SponsorBlock's latest dump by default)"""
+    mirror = SegmentMirror(os.path.join(ctx.obj["data_dir"], mirror_file))
+    print(f"Importing {source}, this can take a while...")
+    start_time = time.monotonic()
+    if source.startswith(("http://", "https://")):
+        request = urllib.request.Request(source, headers={"User-Agent": userAgent})
+        dump = io.TextIOWrapper(urllib.request.urlopen(request), encoding="utf-8", newline="")
+    else:
+        dump = open(source, "r", encoding="utf-8", newline="")
+    with dump:
+        try:
+            kept, deleted = mirror.import_csv(dump, force)
+        except MirrorImportError as e:
+            mirror.close()
+            print(f"{e}. Run again with --force if the dump is right")
+            sys.exit(1)
+    print(f"Imported {kept} segments ({deleted} removed), writing the index...")
+    videos = write_index(mirror, os.path.join(ctx.obj["data_dir"], mirror_index_file))
+    mirror.close()
+    print(
+        f"Indexed {videos} videos in {time.monotonic() - start_time:.0f}s."
+        " Set sponsorblock_mirror to true in the config to use it"
+    )
+
+
 # Create fake "self" group to show pyapp options in help menu
 # Subcommands remove, restore, update
 pyapp_group = click.RichGroup("self", help="pyapp options (update, remove, restore)")
@@ -0,0 +1,104 @@
+import json
+import os
+import re
+
+from . import constants
+
+# Samples needed before the learned latency replaces the manual offset
+MIN_SAMPLES = 3
+# Samples above this (in seconds) are most likely the user seeking, not latency
+MAX_SAMPLE = 5
+# Time the device has to report the position of a seek before it's ignored
+REPORT_TIMEOUT = 10
+# How close the reported position has to be to the seek target, in seconds.
+# Devices can land slightly before the target, but never as early as the segment start
+POSITION_TOLERANCE = (-0.5, 2)
+
+
+def latency_path(data_dir, screen_id):
+    """File the latency of a device is saved to"""
+    return os.path.join(data_dir, constants.latency_file.format(re.sub(r"[^\w-]", "_", screen_id)))
+
+
+class LatencyCalibrator:
+    """Learns how long a device takes to act on a seek.
+    Each seek is timed from the moment it's sent until the device reports the new
+    position, minus half the command round trip (the report's way back). A running
+    average (EWMA) of that replaces the manual offset once there are enough samples.
+    The estimate is saved in its own file (one per device, see latency_path) so it
+    survives restarts and shards never write the same file"""
+
+    def __init__(self, path, screen_id, manual_offset, enabled=True, alpha=0.2):
+        self.path = path
+        self.screen_id = screen_id
+        self.manual_offset = manual_offset
+        self.enabled = enabled
+        self.alpha = alpha
+        self.latency = None
+        self.samples = 0
+        self.pending = None  # [target, time sent, round trip or None, time reported or None]
+        if enabled:
+            self._load()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _load(self):
+        entry = self._read()
+        if entry:
+            self.latency = entry["latency"]
+            self.samples = entry["samples"]
+
+    def _save(self):
+        data = {"latency": self.latency, "samples": self.samples}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving latency calibration to {self.path}: {e}")
+
+    @property
+    def offset(self):
+        """Seconds to skip early by, the learned latency if there's enough data"""
+        if self.enabled and self.samples >= MIN_SAMPLES:
+            return self.latency
+        return self.manual_offset
+
+    def seek_sent(self, target, time_sent):
+        if self.enabled:
+            self.pending = [target, time_sent, None, None]
+
+    def seek_done(self, round_trip):
+        if self.pending and self.pending[2] is None:
+            self.pending[2] = round_trip
+            self._try_sample()
+
+    def position_reported(self, position, time_reported):
+        if not self.pending or self.pending[3] is not None:
+            return
+        if time_reported - self.pending[1] > REPORT_TIMEOUT:
+            self.pending = None
+        elif POSITION_TOLERANCE[0] <= position - self.pending[0] <= POSITION_TOLERANCE[1]:
+            self.pending[3] = time_reported
+            self._try_sample()
+
+    def _try_sample(self):
+        _, time_sent, round_trip, time_reported = self.pending
+        if round_trip is None or time_reported is None:
+            return  # The report can arrive before the command returns
+        self.pending = None
+        sample = max(time_reported - time_sent - round_trip / 2, 0)
+        if sample > MAX_SAMPLE:
+            return
+        if self.latency is None:
+            self.latency = sample
+        else:
+            self.latency += self.alpha * (sample - self.latency)
+        self.samples += 1
+        self._save()
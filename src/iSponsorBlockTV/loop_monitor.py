@@ -0,0 +1,105 @@
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from . import metrics
+
+# Scheduling delays kept for the percentiles
+SAMPLES = 1000
+# Seconds between two delay reports, each one covers the delays since the last
+REPORT_INTERVAL = 60
+
+
+def _describe(frame):
+    """Names the innermost coroutine on the stack and where it's spending its time"""
+    location = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+    innermost = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            coroutine = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+            return coroutine, f"{location} in {innermost}"
+        frame = frame.f_back
+    return innermost, location  # A plain callback, not a task
+
+
+class LoopMonitor:
+    """Measures how long callbacks wait for the event loop, without asyncio debug mode.
+    A thread pings the loop every interval seconds. The time the ping takes to run is the
+    scheduling delay every device's timers see. If it takes longer than the threshold,
+    the thread looks at the loop thread's stack so the log can name the coroutine that
+    was blocking it"""
+
+    def __init__(self, loop, logger, interval=0.5, threshold=0.1):
+        self.loop = loop
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self.delays = deque(maxlen=SAMPLES)
+        self.last_report = time.monotonic()
+        self.culprit = None  # Set by the thread, read by the loop
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()  # Must be called from the loop
+        self.thread = threading.Thread(target=self._run, name="loop-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            answered = threading.Event()
+            try:
+                self.loop.call_soon_threadsafe(self._pong, time.monotonic(), answered)
+            except RuntimeError:  # Loop closed
+                return
+            if answered.wait(self.threshold):
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.culprit = _describe(frame)
+            answered.wait()
+
+    def _pong(self, sent, answered):
+        answered.set()
+        now = time.monotonic()
+        delay = now - sent
+        self.delays.append(delay)
+        metrics.loop_scheduling_delay.observe(delay)
+        culprit, self.culprit = self.culprit, None
+        if delay > self.threshold:
+            coroutine, location = culprit or ("unknown", "unknown")
+            self.logger.warning(
+                "Event loop blocked for %.0f ms by %s (%s)", delay * 1000, coroutine, location
+            )
+            metrics.slow_callbacks.inc(coroutine=coroutine)
+        if now - self.last_report >= REPORT_INTERVAL:
+            self.last_report = now
+            self._report()
+
+    def percentiles(self):
+        """p50, p99 and max of the recent scheduling delays, in seconds"""
+        delays = sorted(self.delays)
+        if not delays:
+            return 0.0, 0.0, 0.0
+        return delays[len(delays) // 2], delays[int(len(delays) * 0.99)], delays[-1]
+
+    def _report(self):
+        p50, p99, worst = self.percentiles()
+        metrics.loop_scheduling_delay_quantiles.set(p50, quantile="0.5")
+        metrics.loop_scheduling_delay_quantiles.set(p99, quantile="0.99")
+        # A p99 over the threshold means skips are being delayed by other devices' work
+        log = self.logger.warning if p99 > self.threshold else self.logger.debug
+        log(
+            "Event loop scheduling delay: p50 %.1f ms, p99 %.1f ms, max %.1f ms",
+            p50 * 1000,
+            p99 * 1000,
+            worst * 1000,
+        )
+        self.delays.clear()
@@ -1,18 +1,23 @@
 import asyncio
+import copy
 import logging
+import os
 import time
 from signal import SIGINT, SIGTERM, signal
-from typing import Optional
 
 import aiohttp
 
-from . import api_helpers, ytlounge
+from . import api_helpers, cache_server, constants, event_loop, metrics, ytlounge
 from .debug_helpers import AiohttpTracer
+from .latency_calibration import LatencyCalibrator, latency_path
+from .loop_monitor import LoopMonitor
+from .skip_reporter import SkipReporter
+from .skip_scheduler import SkipScheduler
+from .supervisor import Supervisor
 
 
 class DeviceListener:
     def __init__(self, api_helper, config, device, debug: bool, web_session):
-        self.task: Optional[asyncio.Task] = None
         self.api_helper = api_helper
         self.offset = device.offset
         self.name = device.name
@@ -20,7 +25,16 @@ class DeviceListener:
         self.logger = logging.getLogger(f"iSponsorBlockTV-{device.screen_id}")
         self.web_session = web_session
         self.lounge_controller = ytlounge.YtLoungeApi(
-            device.screen_id, config, api_helper, self.logger
+            device.screen_id, config, api_helper, self.logger, self.name
+        )
+        self.calibrator = LatencyCalibrator(
+            latency_path(config.data_dir, device.screen_id),
+            device.screen_id,
+            self.offset,
+            enabled=config.auto_offset,
+        )
+        self.scheduler = SkipScheduler(
+            api_helper, self.lounge_controller, self.logger, self.calibrator, config
         )
 
     # Ensures that we have a valid auth token
@@ -66,6 +80,7 @@ class DeviceListener:
             self.logger.info(
                 "Connected to device %s (%s)", lounge_controller.screen_name, self.name
             )
+            metrics.lounge_connections.inc(device=self.name)
             try:
                 self.logger.debug("Subscribing to lounge")
                 sub = await lounge_controller.subscribe_monitored(self)
@@ -75,66 +90,22 @@ class DeviceListener:
 
     # Method called on playback state change
     async def __call__(self, state):
-        time_start = time.monotonic()
-        try:
-            self.task.cancel()
-        except BaseException:
-            pass
-        self.task = asyncio.create_task(self.process_playstatus(state, time_start))
-
-    # Processes the playback state change
-    async def process_playstatus(self, state, time_start):
-        segments = []
-        if state.videoId:
-            segments = await self.api_helper.get_segments(state.videoId)
-        if state.state.value == 1:  # Playing
-            self.logger.info("Playing video %s with %d segments", state.videoId, len(segments))
-            if segments:  # If there are segments
-                await self.time_to_segment(segments, state.currentTime, time_start)
-
-    # Finds the next segment to skip to and skips to it
-    async def time_to_segment(self, segments, position, time_start):
-        start_next_segment = None
-        next_segment = None
-        for segment in segments:
-            segment_start = segment["start"]
-            segment_end = segment["end"]
-            is_within_start_range = (
-                position < 1 < segment_end and segment_start <= position < segment_end
-            )
-            is_beyond_current_position = segment_start > position
-
-            if is_within_start_range or is_beyond_current_position:
-                next_segment = segment
-                start_next_segment = position if is_within_start_range else segment_start
-                break
-        if start_next_segment:
-            time_to_next = (
-                (start_next_segment - position - (time.monotonic() - time_start))
-                / self.lounge_controller.playback_speed
-            ) - self.offset
-            await self.skip(time_to_next, next_segment["end"], next_segment["UUID"])
-
-    # Skips to the next segment (waits for the time to pass)
-    async def skip(self, time_to, position, uuids):
-        await asyncio.sleep(time_to)
-        self.logger.info("Skipping segment: seeking to %s", position)
-        await asyncio.gather(
-            asyncio.create_task(self.lounge_controller.seek_to(position)),
-            asyncio.create_task(self.api_helper.mark_viewed_segments(uuids)),
-        )
+        self.scheduler.update(state, time.monotonic())
 
     async def cancel(self):
         self.cancelled = True
         await self.lounge_controller.disconnect()
-        if self.task:
-            self.task.cancel()
+        scheduler_tasks = (
+            self.scheduler.cancel()
+            + self.lounge_controller.prefetcher.cancel()
+            + self.lounge_controller.dispatcher.cancel()
+        )
         if self.lounge_controller.subscribe_task_watchdog:
             self.lounge_controller.subscribe_task_watchdog.cancel()
         if self.lounge_controller.subscribe_task:
             self.lounge_controller.subscribe_task.cancel()
         await asyncio.gather(
-            self.task,
+            *scheduler_tasks,
             self.lounge_controller.subscribe_task_watchdog,
             self.lounge_controller.subscribe_task,
             return_exceptions=True,
@@ -144,62 +115,174 @@ class DeviceListener:
         await self.lounge_controller.change_web_session(self.web_session)
 
 
-async def finish(devices, web_session, tcp_connector):
+async def finish(devices, *sessions):
     await asyncio.gather(*(device.cancel() for device in devices), return_exceptions=True)
-    await web_session.close()
-    await tcp_connector.close()
+    for session in sessions:
+        await session.close()  # Closes its connector too
+
+
+def create_session(config, pool, limit, limit_per_host, trace_configs):
+    """Session with its own connection pool, so one kind of traffic can't take all
+    the connections of another"""
+    connector = aiohttp.TCPConnector(
+        ttl_dns_cache=300,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=config.http_keepalive_timeout,
+    )
+    trace_configs = list(trace_configs)
+    if config.metrics_port:
+        trace_configs.append(metrics.HttpMetricsTracer(pool).trace_config(aiohttp.TraceConfig()))
+    session = aiohttp.ClientSession(
+        trust_env=config.use_proxy, connector=connector, trace_configs=trace_configs
+    )
+    if config.metrics_port:
+        metrics.collect_pool_stats(pool, session)
+    return session
 
 
 def handle_signal(signum, frame):
     raise KeyboardInterrupt()
 
 
-async def main_async(config, debug, http_tracing):
-    loop = asyncio.get_event_loop_policy().get_event_loop()
+async def main_async(config, debug, http_tracing, shard=None):
+    loop = asyncio.get_running_loop()
     tasks = []  # Save the tasks so the interpreter doesn't garbage collect them
     devices = []  # Save the devices to close them later
     if debug:
         loop.set_debug(True)
 
-    tcp_connector = aiohttp.TCPConnector(ttl_dns_cache=300)
-
+    trace_configs = []
+    http_tracer = None
     # Configure session with tracing if enabled
     if http_tracing:
-        root_logger = logging.getLogger("aiohttp_trace")
-        tracer = AiohttpTracer(root_logger)
-        trace_config = aiohttp.TraceConfig()
-        trace_config.on_request_start.append(tracer.on_request_start)
-        trace_config.on_response_chunk_received.append(tracer.on_response_chunk_received)
-        trace_config.on_request_end.append(tracer.on_request_end)
-        trace_config.on_request_exception.append(tracer.on_request_exception)
-        web_session = aiohttp.ClientSession(
-            trust_env=config.use_proxy, connector=tcp_connector, trace_configs=[trace_config]
+        http_tracer = AiohttpTracer(
+            logging.getLogger("aiohttp_trace"),
+            sample_rate=config.http_trace_sample_rate,
+            buffer_size=config.http_trace_buffer_size,
+            path=config.http_trace_file and os.path.join(config.data_dir, config.http_trace_file),
+            body_bytes=config.http_trace_body_bytes,
+        )
+        trace_configs.append(http_tracer.trace_config())
+    metrics_runner = None
+    if config.metrics_port:
+        metrics_runner = await metrics.start_server(
+            config.metrics_host, config.metrics_port, http_tracer
         )
-    else:
-        web_session = aiohttp.ClientSession(trust_env=config.use_proxy, connector=tcp_connector)
+        print(f"Serving metrics on http://{config.metrics_host}:{config.metrics_port}/metrics")
+    # SponsorBlock and YouTube Data API calls (prefetches, skip reports) get their own
+    # pool, lounge commands and long polls always find a connection in theirs
+    web_session = create_session(
+        config, "api", config.http_pool_size, config.http_pool_per_host, trace_configs
+    )
+    lounge_session = create_session(
+        config, "lounge", config.lounge_pool_size or 3 * len(config.devices), 0, trace_configs
+    )
 
-    api_helper = api_helpers.ApiHelper(config, web_session)
+    # Each shard keeps its own pending reports
+    skip_reports_file = constants.skip_reports_file
+    if shard is not None:
+        skip_reports_file = f"{shard}.{skip_reports_file}"
+    skip_reporter = SkipReporter(web_session, os.path.join(config.data_dir, skip_reports_file))
+    api_helper = api_helpers.ApiHelper(config, web_session, skip_reporter)
+    metrics.collect_cache_stats(api_helper.segments_cache)
+    cache_server_runner = None
+    if config.cache_server_port:
+        cache_server_runner = await cache_server.start_server(
+            api_helper, config.cache_server_host, config.cache_server_port
+        )
+        print(
+            "Serving the segment cache on "
+            f"http://{config.cache_server_host}:{config.cache_server_port}/api/"
+        )
     for i in config.devices:
-        device = DeviceListener(api_helper, config, i, debug, web_session)
+        device = DeviceListener(api_helper, config, i, debug, lounge_session)
         devices.append(device)
         await device.initialize_web_session()
         tasks.append(loop.create_task(device.loop()))
         tasks.append(loop.create_task(device.refresh_auth_loop()))
+    if config.skip_count_tracking:
+        skip_reporter.start()  # Sends the reports left from the last run
+    loop_monitor = None
+    if config.loop_monitor_interval:
+        loop_monitor = LoopMonitor(
+            loop,
+            logging.getLogger("iSponsorBlockTV-loop"),
+            config.loop_monitor_interval,
+            config.slow_callback_threshold / 1000,
+        )
+        loop_monitor.start()
     signal(SIGTERM, handle_signal)
     signal(SIGINT, handle_signal)
     try:
         await asyncio.gather(*tasks)
     except KeyboardInterrupt:
         print("Cancelling tasks and exiting...")
-        await finish(devices, web_session, tcp_connector)
+        await finish(devices, web_session, lounge_session)
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
     finally:
+        if loop_monitor:
+            loop_monitor.stop()
+        await skip_reporter.close()
         await web_session.close()
-        await tcp_connector.close()
+        await lounge_session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if cache_server_runner:
+            await cache_server_runner.cleanup()
+        if http_tracer:
+            http_tracer.close()
         print("Exited")
 
 
+def run_shard(config, debug, http_tracing, shard):
+    """Entry point of a shard's process, runs its devices on its own loop and session"""
+    logger = logging.getLogger()
+    if not logger.handlers:  # Spawned processes don't inherit the logging setup
+        sh = logging.StreamHandler()
+        logger.addHandler(sh)
+        logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    for handler in logger.handlers:
+        handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s"
+            )
+        )
+    try:
+        event_loop.run(main_async(config, debug, http_tracing, shard), config.event_loop)
+    except KeyboardInterrupt:
+        pass
+
+
 def main(config, debug, http_tracing):
-    asyncio.run(main_async(config, debug, http_tracing))
+    shards = min(config.shards or os.cpu_count() or 1, len(config.devices))
+    if shards <= 1:
+        event_loop.run(main_async(config, debug, http_tracing), config.event_loop)
+        return
+    # Split the devices between processes. They share segments through the segment
+    # store, each one keeps its own in memory cache on top of it
+    if not config.persistent_segment_cache:
+        print("persistent_segment_cache is disabled, shards won't share segments")
+    supervisor = Supervisor(logging.getLogger("iSponsorBlockTV-supervisor"))
+    for i in range(shards):
+        shard_config = copy.copy(config)
+        shard_config.devices = config.devices[i::shards]
+        if config.metrics_port:
+            shard_config.metrics_port = config.metrics_port + i
+        if config.cache_server_port and i:
+            # Only the first shard serves the cache, the others use it
+            shard_config.cache_server_port = 0
+            if not config.segment_cache_server:
+                host = config.cache_server_host
+                if host in ("0.0.0.0", "::", ""):
+                    host = "127.0.0.1"
+                shard_config.segment_cache_server = f"http://{host}:{config.cache_server_port}/api/"
+        supervisor.add(f"shard-{i}", run_shard, shard_config, debug, http_tracing, i)
+    print(f"Running {len(config.devices)} devices in {shards} shards")
+    signal(SIGTERM, handle_signal)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("Stopping shards...")
@@ -0,0 +1,327 @@
+"""Minimal Prometheus instrumentation (text exposition format 0.0.4).
+Metrics are module level so any part of the daemon can record them, they are only
+exported when the metrics endpoint is enabled (metrics_port in the config)"""
+
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Seconds, fine grained at the low end where skip accuracy matters
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}  # Sorted label tuples -> value
+        (registry or REGISTRY).register(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """For counters kept elsewhere (e.g. cache stats) and copied in on collection"""
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = self._header()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = self._header()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            # Per bucket counts (+Inf last), sum, count
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = self._header()
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = (("le", bound if bound == "+Inf" else repr(float(bound))),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # Called before rendering to copy in values kept elsewhere
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            if metric.values:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+segment_cache_requests = Counter(
+    "isponsorblocktv_segment_cache_requests_total",
+    "Segment cache lookups by result (hit, stale_hit, miss, coalesced)",
+)
+segment_cache_evictions = Counter(
+    "isponsorblocktv_segment_cache_evictions_total", "Segment cache entries evicted by size"
+)
+segment_cache_hit_ratio = Gauge(
+    "isponsorblocktv_segment_cache_hit_ratio", "Share of segment lookups served from the cache"
+)
+segment_cache_size = Gauge("isponsorblocktv_segment_cache_size", "Entries in the segment cache")
+skip_reports = Counter(
+    "isponsorblocktv_skip_reports_total",
+    "Skip reports to SponsorBlock by result (sent, retried, dropped)",
+)
+prefetches = Counter(
+    "isponsorblocktv_prefetches_total",
+    "Upcoming videos prefetched (fetched, error) or dropped before they were fetched",
+)
+segment_cache_server_fallbacks = Counter(
+    "isponsorblocktv_segment_cache_server_fallbacks_total",
+    "Lookups that went to SponsorBlock because the segment cache server failed",
+)
+http_request_duration = Histogram(
+    "isponsorblocktv_http_request_duration_seconds",
+    "Time until response headers, by upstream (sponsorblock, youtube_data, lounge)",
+)
+http_request_errors = Counter(
+    "isponsorblocktv_http_request_errors_total", "Requests that failed without a response"
+)
+http_pool_connections = Gauge(
+    "isponsorblocktv_http_pool_connections",
+    "Connections per pool (lounge, api) that are in use or idle (kept alive)",
+)
+http_pool_limit = Gauge("isponsorblocktv_http_pool_limit", "Connections allowed per pool")
+http_pool_waiting = Gauge(
+    "isponsorblocktv_http_pool_waiting", "Requests waiting for a connection, the pool is full"
+)
+http_pool_wait = Histogram(
+    "isponsorblocktv_http_pool_wait_seconds",
+    "Time requests waited for a free connection in a full pool",
+)
+skip_timing_error = Histogram(
+    "isponsorblocktv_skip_timing_error_seconds",
+    "How late each seek was sent compared to the predicted segment start",
+    buckets=(-0.1, -0.05, -0.025, -0.01, 0, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+position_drift = Histogram(
+    "isponsorblocktv_position_drift_seconds",
+    "Position reported by the device minus the predicted one, by device",
+    buckets=(-1, -0.5, -0.25, -0.1, -0.05, -0.025, 0, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+lounge_command_duration = Histogram(
+    "isponsorblocktv_lounge_command_duration_seconds",
+    "Time to send a lounge command and get the reply, by device and command",
+)
+lounge_command_wait = Histogram(
+    "isponsorblocktv_lounge_command_wait_seconds",
+    "Time a lounge command waited for the commands before it, by device and command",
+)
+lounge_commands_coalesced = Counter(
+    "isponsorblocktv_lounge_commands_coalesced_total",
+    "Lounge commands merged into a queued one of the same kind instead of being sent",
+)
+lounge_polls = Counter(
+    "isponsorblocktv_lounge_polls_total",
+    "Lounge long polls ended by the server or replaced before their timeout (rotated)",
+)
+lounge_stream_gap = Histogram(
+    "isponsorblocktv_lounge_stream_gap_seconds",
+    "Time without an open lounge poll between two polls, events in it arrive this late",
+)
+lounge_connections = Counter(
+    "isponsorblocktv_lounge_connections_total", "Successful (re)connections to a device's lounge"
+)
+watchdog_triggers = Counter(
+    "isponsorblocktv_watchdog_triggers_total", "Lounge subscriptions cancelled by the watchdog"
+)
+event_loop_lag = Histogram(
+    "isponsorblocktv_event_loop_lag_seconds",
+    "Delay between when a device's timer was due and when it ran",
+)
+loop_scheduling_delay = Histogram(
+    "isponsorblocktv_loop_scheduling_delay_seconds",
+    "Time a callback waited for the event loop, sampled by the loop monitor",
+)
+loop_scheduling_delay_quantiles = Gauge(
+    "isponsorblocktv_loop_scheduling_delay_quantile_seconds",
+    "Recent loop scheduling delay percentiles, updated every report",
+)
+slow_callbacks = Counter(
+    "isponsorblocktv_slow_callbacks_total",
+    "Times the event loop was blocked over the threshold, by the coroutine blocking it",
+)
+
+
+def collect_cache_stats(cache):
+    def collector():
+        stats = cache.stats()
+        for key, result in (
+            ("hits", "hit"),
+            ("stale_hits", "stale_hit"),
+            ("misses", "miss"),
+            ("coalesced", "coalesced"),
+        ):
+            segment_cache_requests.set(stats[key], result=result)
+        segment_cache_evictions.set(stats["evictions"])
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"] + stats["coalesced"]
+        if lookups:
+            segment_cache_hit_ratio.set((stats["hits"] + stats["stale_hits"]) / lookups)
+        segment_cache_size.set(stats["size"])
+
+    REGISTRY.add_collector(collector)
+
+
+def collect_pool_stats(pool, session):
+    connector = session.connector
+
+    def collector():
+        # aiohttp has no public pool stats, these are the connector's own bookkeeping
+        in_use = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        http_pool_connections.set(in_use, pool=pool, state="in_use")
+        http_pool_connections.set(idle, pool=pool, state="idle")
+        http_pool_limit.set(connector.limit, pool=pool)
+
+    REGISTRY.add_collector(collector)
+
+
+_upstreams = {
+    "sponsor.ajay.app": "sponsorblock",
+    "www.googleapis.com": "youtube_data",
+    "www.youtube.com": "lounge",
+}
+
+
+def _upstream(url):
+    return _upstreams.get(url.host, url.host)
+
+
+class HttpMetricsTracer:
+    """aiohttp trace hooks recording per upstream request latency,
+    and how long requests waited for a connection of the session's pool"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.waiting = 0
+
+    @staticmethod
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    @staticmethod
+    async def on_request_end(session, context, params):
+        http_request_duration.observe(
+            time.monotonic() - context.start, upstream=_upstream(params.url)
+        )
+
+    @staticmethod
+    async def on_request_exception(session, context, params):
+        http_request_errors.inc(upstream=_upstream(params.url))
+
+    async def on_connection_queued_start(self, session, context, params):
+        context.queued = time.monotonic()
+        self.waiting += 1
+        http_pool_waiting.set(self.waiting, pool=self.pool)
+
+    async def on_connection_queued_end(self, session, context, params):
+        self.waiting -= 1
+        http_pool_waiting.set(self.waiting, pool=self.pool)
+        http_pool_wait.observe(time.monotonic() - context.queued, pool=self.pool)
+
+    def trace_config(self, trace_config):
+        trace_config.on_connection_queued_start.append(self.on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self.on_connection_queued_end)
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_exception)
+        return trace_config
+
+
+async def start_server(host, port, http_tracer=None):
+    """Serves the metrics on http://host:port/metrics, returns the runner to clean it up.
+    With HTTP tracing enabled, the latest traced requests are served on /debug/http"""
+
+    async def handle_metrics(request):
+        return web.Response(
+            text=REGISTRY.render(),
+            headers={
+                "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                "Cache-Control": "no-cache",
+            },
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    if http_tracer is not None:
+
+        async def handle_http_traces(request):
+            return web.json_response(list(http_tracer.records))
+
+        app.router.add_get("/debug/http", handle_http_traces)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
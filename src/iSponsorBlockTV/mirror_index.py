@@ -0,0 +1,228 @@
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Read-only binary copy of the SponsorBlock mirror, opened with mmap so every process
+# shares the same pages and nothing is parsed until a video is looked up.
+#
+# Layout (in the byte order of the host that wrote it), every section starts on an
+# 8 byte boundary:
+#   header      magic, byte order, video count, segment count, uuid bytes, category count
+#   categories  length (u8) + UTF-8 name, their position is their code
+#   keys_high   u64 per video, first 8 bytes of the NUL padded video id (big endian), sorted
+#   keys_low    u64 per video, the last 8 bytes
+#   first       u32 per video + 1, index of its first segment (the next one's is its end)
+#   starts      f32 per segment
+#   ends        f32 per segment
+#   flags       u8 per segment, category code in the low 7 bits, locked in the high one
+#   uuid_ends   u32 per segment + 1, offsets in the uuid blob
+#   uuids       ASCII segment UUIDs, back to back
+
+MAGIC = b"ISBTVMI1"
+HEADER = struct.Struct("=8s1sIIII")
+BYTE_ORDER = sys.byteorder[0].encode()
+KEY_SIZE = 16  # Video ids are 11 characters
+LOCKED = 0x80
+# Items buffered per section while writing
+CHUNK = 65536
+# Seconds between checks for a newer index on disk
+RELOAD_INTERVAL = 60
+
+
+def _padding(size):
+    return -size % 8
+
+
+def _key(vid_id):
+    """Splits a video id into two integers that sort like the id"""
+    key = vid_id.encode("ascii")
+    if len(key) > KEY_SIZE:
+        raise ValueError("Not a YouTube video id")
+    key = key.ljust(KEY_SIZE, b"\0")
+    return int.from_bytes(key[:8], "big"), int.from_bytes(key[8:], "big")
+
+
+class _Section:
+    """Typed array written to a temporary file in chunks, so memory stays flat"""
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.items = array(typecode)
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def append(self, item):
+        self.items.append(item)
+        if len(self.items) >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        self.size += len(self.items) * self.items.itemsize
+        self.items.tofile(self.file)
+        self.items = array(self.typecode)
+
+    def copy_to(self, out):
+        self.flush()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, out)
+        self.file.close()
+        out.write(b"\0" * _padding(self.size))
+
+
+def write_index(mirror, path):
+    """Writes the index of a SegmentMirror to path, replacing the old one atomically.
+    Returns the number of videos"""
+    categories = mirror.categories()
+    if len(categories) > 127:
+        raise ValueError("Too many categories for the index")
+    codes = {category: i for i, category in enumerate(categories)}
+    keys_high = _Section("Q")
+    keys_low = _Section("Q")
+    first = _Section("I")
+    starts = _Section("f")
+    ends = _Section("f")
+    flags = _Section("B")
+    uuid_ends = _Section("I")
+    uuids = tempfile.TemporaryFile()
+    last_video = None
+    segments = uuid_bytes = videos = 0
+    uuid_ends.append(0)
+    for video_id, uuid, start, end, category, locked in mirror.iter_segments():
+        if video_id != last_video:
+            try:
+                high, low = _key(video_id)
+            except (ValueError, UnicodeEncodeError):
+                continue
+            last_video = video_id
+            videos += 1
+            first.append(segments)
+            keys_high.append(high)
+            keys_low.append(low)
+        segments += 1
+        starts.append(start)
+        ends.append(end)
+        flags.append(codes[category] | (LOCKED if locked else 0))
+        encoded = uuid.encode("ascii")
+        uuids.write(encoded)
+        uuid_bytes += len(encoded)
+        uuid_ends.append(uuid_bytes)
+    first.append(segments)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as out:
+        header = HEADER.pack(MAGIC, BYTE_ORDER, videos, segments, uuid_bytes, len(categories))
+        for category in categories:
+            encoded = category.encode("utf-8")
+            header += bytes((len(encoded),)) + encoded
+        out.write(header + b"\0" * _padding(len(header)))
+        for section in (keys_high, keys_low, first, starts, ends, flags, uuid_ends):
+            section.copy_to(out)
+        uuids.seek(0)
+        shutil.copyfileobj(uuids, out)
+        uuids.close()
+    os.replace(tmp_path, path)
+    return videos
+
+
+class MirrorIndex:
+    """Looks videos up in an index written by write_index.
+    Same interface as SegmentMirror.get(), the index is reopened when a newer one is
+    written (checked every RELOAD_INTERVAL seconds)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+        self.stat = None
+        self.next_check = 0.0
+
+    def _open(self):
+        stat = os.stat(self.path)
+        if self.stat and (stat.st_ino, stat.st_mtime_ns) == self.stat:
+            return
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, videos, segments, uuid_bytes, category_count = HEADER.unpack_from(buffer)
+        if magic != MAGIC or byte_order != BYTE_ORDER:
+            buffer.close()
+            raise ValueError(f"{self.path} isn't a segment index written on this host")
+        offset = HEADER.size
+        self.categories = []
+        for _ in range(category_count):
+            length = buffer[offset]
+            self.categories.append(buffer[offset + 1 : offset + 1 + length].decode("utf-8"))
+            offset += 1 + length
+        offset += _padding(offset)
+        view = memoryview(buffer)
+
+        def section(typecode, count, itemsize):
+            nonlocal offset
+            size = count * itemsize
+            data = view[offset : offset + size].cast(typecode) if typecode else offset
+            offset += size + _padding(size)
+            return data
+
+        self.keys_high = section("Q", videos, 8)
+        self.keys_low = section("Q", videos, 8)
+        self.first = section("I", videos + 1, 4)
+        self.starts = section("f", segments, 4)
+        self.ends = section("f", segments, 4)
+        self.flags = section("B", segments, 1)
+        self.uuid_ends = section("I", segments + 1, 4)
+        self.uuids = section(None, uuid_bytes, 1)
+        self.view = view
+        self.mmap = buffer  # The old one is unmapped once its views are gone
+        self.stat = (stat.st_ino, stat.st_mtime_ns)
+        self.wanted = {}  # Category codes by requested categories
+
+    def get(self, vid_id, categories):
+        """Returns the video like the skipSegments API does, None if there's no index"""
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + RELOAD_INTERVAL
+            try:
+                self._open()
+            except (OSError, ValueError) as e:
+                if self.mmap is None:
+                    print(f"Error opening segment index {self.path}: {e}")
+                    return None
+        if self.mmap is None:
+            return None
+        try:
+            high, low = _key(vid_id)
+        except (ValueError, UnicodeEncodeError):
+            return None
+        segments = []
+        # bisect runs in C straight over the mmap
+        start = bisect_left(self.keys_high, high)
+        end = bisect_right(self.keys_high, high, start)
+        i = bisect_left(self.keys_low, low, start, end)
+        if i < end and self.keys_low[i] == low:
+            categories = tuple(categories)
+            wanted = self.wanted.get(categories)
+            if wanted is None:
+                wanted = self.wanted[categories] = {
+                    code for code, name in enumerate(self.categories) if name in categories
+                }
+            for j in range(self.first[i], self.first[i + 1]):
+                flags = self.flags[j]
+                if flags & ~LOCKED not in wanted:
+                    continue
+                uuid = self.view[
+                    self.uuids + self.uuid_ends[j] : self.uuids + self.uuid_ends[j + 1]
+                ]
+                segments.append(
+                    {
+                        # float32, rounded back to what SponsorBlock sent
+                        "segment": [round(self.starts[j], 3), round(self.ends[j], 3)],
+                        "UUID": bytes(uuid).decode("ascii"),
+                        "category": self.categories[flags & ~LOCKED],
+                        "locked": 1 if flags & LOCKED else 0,
+                        "actionType": "skip",
+                    }
+                )
+        return {"videoID": vid_id, "segments": segments}
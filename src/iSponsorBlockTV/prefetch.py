@@ -0,0 +1,84 @@
+import asyncio
+from collections import OrderedDict
+
+from . import metrics
+
+
+class Prefetcher:
+    """Per device queue of videos to get the segments of before they play.
+    The next video (autoplay, the video after an ad) goes first, then up to depth
+    videos of the lounge queue. Videos are fetched one at a time so prefetching never
+    competes with the video that's playing, and videos the user skipped past are dropped
+    before they're fetched"""
+
+    def __init__(self, api_helper, logger, depth=3, name=None):
+        self.api_helper = api_helper
+        self.logger = logger
+        self.depth = depth
+        self.name = name
+        self.pending = OrderedDict()  # Video ids in fetch order -> urgent
+        self.fetched = OrderedDict()  # Recently prefetched, not queued again
+        self.task = None
+
+    def add(self, video_id, urgent=False):
+        """Queues a video, urgent ones (the next video) skip to the front"""
+        if not video_id or video_id in self.fetched:
+            return
+        self.pending[video_id] = urgent or self.pending.get(video_id, False)
+        if urgent:
+            self.pending.move_to_end(video_id, last=False)
+        while len(self.pending) > self.depth + 1:  # The queue plus the next video
+            self._drop(next(reversed(self.pending)))
+        self._start()
+
+    def queue(self, video_ids, current_index):
+        """Plans the videos after current_index in the lounge queue,
+        replacing the ones planned before (urgent ones are kept)"""
+        upcoming = video_ids[current_index + 1 : current_index + 1 + self.depth]
+        for video_id, urgent in list(self.pending.items()):
+            if not urgent and video_id not in upcoming:
+                self._drop(video_id)
+        for video_id in upcoming:
+            self.add(video_id)
+
+    def playing(self, video_id):
+        """Drops the video that started playing and everything queued before it"""
+        if video_id not in self.pending:
+            return
+        for queued in list(self.pending):
+            self._drop(queued)
+            if queued == video_id:
+                break
+
+    def _drop(self, video_id):
+        del self.pending[video_id]
+        metrics.prefetches.inc(device=self.name, result="dropped")
+
+    def _start(self):
+        if self.pending and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            video_id, _ = self.pending.popitem(last=False)
+            self.fetched[video_id] = None
+            if len(self.fetched) > 2 * (self.depth + 1):
+                self.fetched.popitem(last=False)
+            self.logger.info("Getting segments for next video: %s", video_id)
+            try:
+                await self.api_helper.get_segments(video_id)
+            except Exception as e:
+                self.logger.debug("Prefetching segments for %s failed: %s", video_id, e)
+                self.fetched.pop(video_id, None)  # Can be queued again
+                result = "error"
+            else:
+                result = "fetched"
+            metrics.prefetches.inc(device=self.name, result=result)
+
+    def cancel(self):
+        """Stops prefetching, returns the task to be awaited"""
+        self.pending.clear()
+        if self.task is None:
+            return []
+        self.task.cancel()
+        return [self.task]
@@ -0,0 +1,211 @@
+import csv
+import sqlite3
+import time
+
+# Rows written per transaction while importing
+BATCH_SIZE = 50000
+# Descriptions and user agents can be long
+FIELD_SIZE_LIMIT = 1 << 24
+# Share of the mirror's rows a dump has to keep before the missing ones are deleted.
+# A dump cut short without an error (truncated download, proxy) would wipe the rest
+MIN_KEPT_SHARE = 0.9
+
+
+class MirrorImportError(Exception):
+    pass
+
+
+def _number(value, default=0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class SegmentMirror:
+    """Local copy of SponsorBlock's database, built from its sponsorTimes.csv dump.
+    Lookups are an indexed SQLite read instead of a request per video.
+    Only segments the API would return are kept: YouTube skip segments that aren't
+    hidden or voted down (votes > -2)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._imported = None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sponsor_times ("
+                "uuid TEXT PRIMARY KEY, "
+                "video_id TEXT NOT NULL, "
+                "start REAL NOT NULL, "
+                "end REAL NOT NULL, "
+                "category TEXT NOT NULL, "
+                "locked INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS sponsor_times_video ON sponsor_times (video_id)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db = db
+        return self._db
+
+    def imported_at(self):
+        """Time of the last complete import, None if there's none"""
+        if self._imported is None:  # Checked again until it's there, it can be imported live
+            row = (
+                self._connect()
+                .execute("SELECT value FROM meta WHERE key = 'imported_at'")
+                .fetchone()
+            )
+            self._imported = float(row[0]) if row else None
+        return self._imported
+
+    def get(self, vid_id, categories):
+        """Returns the video like the skipSegments API does, None if the mirror is empty"""
+        try:
+            if not self.imported_at():
+                return None
+            rows = (
+                self._connect()
+                .execute(
+                    "SELECT uuid, start, end, category, locked FROM sponsor_times "
+                    f"WHERE video_id = ? AND category IN ({','.join('?' * len(categories))})",
+                    (vid_id, *categories),
+                )
+                .fetchall()
+            )
+        except sqlite3.Error as e:
+            print(f"Error reading SponsorBlock mirror {self.path}: {e}")
+            return None
+        return {
+            "videoID": vid_id,
+            "segments": [
+                {
+                    "segment": [start, end],
+                    "UUID": uuid,
+                    "category": category,
+                    "locked": locked,
+                    "actionType": "skip",
+                }
+                for uuid, start, end, category, locked in rows
+            ],
+        }
+
+    def categories(self):
+        return [
+            row[0]
+            for row in self._connect().execute(
+                "SELECT DISTINCT category FROM sponsor_times ORDER BY category"
+            )
+        ]
+
+    def iter_segments(self):
+        """Yields (video_id, uuid, start, end, category, locked) sorted by video id"""
+        yield from self._connect().execute(
+            "SELECT video_id, uuid, start, end, category, locked FROM sponsor_times "
+            "ORDER BY video_id, start"
+        )
+
+    def import_csv(self, lines, force=False):
+        """Updates the mirror from the lines of a sponsorTimes.csv dump, streamed one row
+        at a time. Only rows that changed are written, segments that are gone from the
+        dump (or are now hidden) are deleted. Returns (rows kept, rows deleted).
+        Raises MirrorImportError, without deleting or marking the mirror imported, if the
+        dump kept less than MIN_KEPT_SHARE of the rows, unless force is set"""
+        csv.field_size_limit(FIELD_SIZE_LIMIT)
+        reader = csv.reader(lines)
+        columns = {name: i for i, name in enumerate(next(reader))}
+        uuid, video_id, start, end, votes, locked, category, action_type, service = (
+            columns[name]
+            for name in (
+                "UUID",
+                "videoID",
+                "startTime",
+                "endTime",
+                "votes",
+                "locked",
+                "category",
+                "actionType",
+                "service",
+            )
+        )
+        # Missing in old dumps
+        hidden = [columns[name] for name in ("hidden", "shadowHidden") if name in columns]
+        db = self._connect()
+        previous = db.execute("SELECT COUNT(*) FROM sponsor_times").fetchone()[0]
+        # The temp table lives outside the mirror file, it doesn't grow the WAL
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (uuid TEXT PRIMARY KEY) WITHOUT ROWID")
+        db.execute("DELETE FROM temp.seen")
+        kept = 0
+        batch = []
+        for row in reader:
+            if (
+                len(row) < len(columns)  # Truncated line
+                or row[service] != "YouTube"
+                or row[action_type] != "skip"
+                or _number(row[votes]) <= -2
+                or any(row[i] not in ("0", "") for i in hidden)
+            ):
+                continue
+            batch.append(
+                (
+                    row[uuid],
+                    row[video_id],
+                    _number(row[start]),
+                    _number(row[end]),
+                    row[category],
+                    int(_number(row[locked])),
+                )
+            )
+            if len(batch) >= BATCH_SIZE:
+                self._write(db, batch)
+                kept += len(batch)
+                batch = []
+        self._write(db, batch)
+        kept += len(batch)
+        if not force and kept < previous * MIN_KEPT_SHARE:
+            db.execute("DELETE FROM temp.seen")
+            raise MirrorImportError(
+                f"The dump has {kept} segments, the mirror {previous}. It may be incomplete,"
+                " nothing was removed"
+            )
+        imported = time.time()
+        with db:
+            db.execute("BEGIN")
+            deleted = db.execute(
+                "DELETE FROM sponsor_times WHERE uuid NOT IN (SELECT uuid FROM temp.seen)"
+            ).rowcount
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_at', ?)",
+                (str(imported),),
+            )
+        self._imported = imported
+        db.execute("DELETE FROM temp.seen")
+        return kept, deleted
+
+    @staticmethod
+    def _write(db, batch):
+        with db:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR IGNORE INTO temp.seen (uuid) VALUES (?)", ((b[0],) for b in batch)
+            )
+            # Unchanged rows aren't rewritten, refreshing mostly reads
+            db.executemany(
+                "INSERT INTO sponsor_times (uuid, video_id, start, end, category, locked) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (uuid) DO UPDATE SET "
+                "video_id = excluded.video_id, start = excluded.start, end = excluded.end, "
+                "category = excluded.category, locked = excluded.locked "
+                "WHERE (video_id, start, end, category, locked) IS NOT "
+                "(excluded.video_id, excluded.start, excluded.end, excluded.category, "
+                "excluded.locked)",
+                batch,
+            )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+import time
+
+from .segments import Segment, SegmentIndex
+
+
+class SegmentStore:
+    """Persistent segment cache backed by SQLite.
+    Survives restarts so cold lookups are served from disk instead of the API.
+    Entries with ignore_ttl (all segments locked) never expire,
+    the rest expire after time_to_live seconds"""
+
+    def __init__(self, path, time_to_live=300):
+        self.path = path
+        self.time_to_live = time_to_live
+        self._db = None
+
+    # Opened lazily, the setup wizard creates an ApiHelper but never fetches segments
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "video_id TEXT NOT NULL, "
+                "params TEXT NOT NULL, "
+                "segments TEXT NOT NULL, "
+                "expires_at REAL, "  # NULL = never expires
+                "PRIMARY KEY (video_id, params))"
+            )
+            db.execute("DELETE FROM segments WHERE expires_at < ?", (time.time(),))
+            self._db = db
+        return self._db
+
+    def get(self, vid_id, params=""):
+        """Returns (segments, ignore_ttl) or None if missing or expired"""
+        try:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT segments, expires_at FROM segments WHERE video_id = ? AND params = ?",
+                    (vid_id, params),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            # A broken store shouldn't stop segments from being fetched
+            print(f"Error reading segment store {self.path}: {e}")
+            return None
+        if row is None:
+            return None
+        segments, expires_at = row
+        # Wall clock on purpose, expiry has to survive restarts
+        if expires_at is not None and expires_at < time.time():
+            self.delete(vid_id, params)
+            return None
+        try:
+            return SegmentIndex(map(Segment.from_json, json.loads(segments))), expires_at is None
+        except (ValueError, TypeError):  # Written by an older version, refetch it
+            self.delete(vid_id, params)
+            return None
+
+    def put(self, vid_id, segments, ignore_ttl, params=""):
+        expires_at = (
+            None if ignore_ttl or not self.time_to_live else time.time() + self.time_to_live
+        )
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO segments (video_id, params, segments, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (vid_id, params, json.dumps(tuple(segments), separators=(",", ":")), expires_at),
+            )
+        except sqlite3.Error as e:
+            print(f"Error writing segment store {self.path}: {e}")
+
+    def delete(self, vid_id, params=""):
+        self._connect().execute(
+            "DELETE FROM segments WHERE video_id = ? AND params = ?", (vid_id, params)
+        )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
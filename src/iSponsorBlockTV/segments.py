@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from array import array
+from bisect import bisect_right
+from typing import NamedTuple
+
+
+class Segment(NamedTuple):
+    """A (merged) segment to skip.
+    Immutable, so cached tuples of segments are shared by every device without copying"""
+
+    start: float
+    end: float
+    uuids: tuple[str, ...]  # Every SponsorBlock segment merged into this one
+    category: str  # Category of the first merged segment
+    locked: bool  # True if all merged segments are locked
+
+    @classmethod
+    def from_json(cls, data):
+        """Builds a segment from its JSON form (a list, as NamedTuples are serialized)"""
+        start, end, uuids, category, locked = data
+        return cls(start, end, tuple(uuids), category, locked)
+
+
+class SegmentIndex:
+    """Segments of a video sorted by start, with their starts and ends in arrays
+    so the next segment is found with a binary search.
+    Built once when the segments are fetched and cached with them, every playback
+    event (and device) playing the video reuses it"""
+
+    __slots__ = ("segments", "starts", "ends")
+
+    def __init__(self, segments=()):
+        self.segments = tuple(segments)  # Sorted by start and not overlapping
+        self.starts = array("d", (segment.start for segment in self.segments))
+        self.ends = array("d", (segment.end for segment in self.segments))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __getitem__(self, index):
+        return self.segments[index]
+
+    def __repr__(self):
+        return f"SegmentIndex({self.segments!r})"
+
+    def next_segment(self, position):
+        """Returns the next segment to skip from position and the time it starts being
+        skipped, or (None, None) if there are no more segments"""
+        i = bisect_right(self.starts, position)  # First segment starting after position
+        # Segments don't overlap, only the one before can contain position.
+        # It's only skipped when the video just started
+        if i and position < 1 < self.ends[i - 1]:
+            return self.segments[i - 1], position
+        if i < len(self.segments):
+            return self.segments[i], self.starts[i]
+        return None, None
@@ -531,10 +531,11 @@ class EditDevice(ModalWithClickExit):
 
     BINDINGS = [("escape", "close_screen_saving", "Return")]
 
-    def __init__(self, device: Element, **kwargs) -> None:
+    def __init__(self, device: Element, config, **kwargs) -> None:
         super().__init__(**kwargs)
         self.device_data = device.element_data
         self.device_widget = device
+        self.config = config
 
     def action_close_screen_saving(self) -> None:
         self.dismiss()
@@ -561,7 +562,12 @@ class EditDevice(ModalWithClickExit):
                     password=True,
                 )
                 yield Button("Show id", id="device-id-view")
-            yield Label("Device offset (in milliseconds)")
+            if getattr(self.config, "auto_offset", False):
+                yield Label(
+                    "Device offset (in milliseconds, used until the device's latency is learned)"
+                )
+            else:
+                yield Label("Device offset (in milliseconds)")
             with Horizontal(id="device-offset-container"):
                 yield Input(id="device-offset-input", value=str(offset))
                 yield Slider(
@@ -639,7 +645,7 @@ class DevicesManager(Vertical):
     @on(Button.Pressed, "#element-name")
     def edit_channel(self, event: Button.Pressed):
         channel_to_edit: Element = event.button.parent
-        self.app.push_screen(EditDevice(channel_to_edit), callback=self.edit_device)
+        self.app.push_screen(EditDevice(channel_to_edit, self.config), callback=self.edit_device)
 
 
 class ApiKeyManager(Vertical):
@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import json
+import os
+
+from aiohttp import ClientError
+
+from . import constants, metrics
+
+# Reports sent at the same time
+CONCURRENCY = 2
+# Reports kept at most, new ones are dropped past this
+MAX_PENDING = 10000
+# Attempts before a report is given up on
+MAX_ATTEMPTS = 8
+# Seconds before the first retry, doubled on every attempt
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 3600
+# Seconds to wait before saving the pending reports after a change
+SAVE_DELAY = 5
+
+
+class SkipReporter:
+    """Reports skipped segments to SponsorBlock (viewedVideoSponsorTime) in the
+    background. Reports are queued, sent a few at a time, retried with backoff when
+    SponsorBlock is unreachable or rate limiting, and saved to disk until they're sent
+    so they survive restarts"""
+
+    def __init__(self, web_session, path):
+        self.web_session = web_session
+        self.path = path
+        # Report id -> [UUID, attempts], queued, being sent or waiting for a retry.
+        # Every skip is a report, skipping a segment twice counts two views
+        self.pending = {}
+        self.ids = itertools.count()
+        self.queue = None
+        self.workers = []
+        self.save_handle = None
+
+    def start(self):
+        """Starts sending, reports left from the last run first"""
+        self.queue = asyncio.Queue()
+        for uuid in self._load():
+            self._add(uuid)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(CONCURRENCY)]
+
+    def report(self, uuids):
+        """Queues the UUIDs of skipped segments, returns right away"""
+        if self.queue is None:
+            self.start()
+        for uuid in uuids:
+            if len(self.pending) >= MAX_PENDING:
+                metrics.skip_reports.inc(result="dropped")
+                continue
+            self._add(uuid)
+        self._schedule_save()
+
+    def _add(self, uuid):
+        report_id = next(self.ids)
+        self.pending[report_id] = [uuid, 0]
+        self.queue.put_nowait(report_id)
+
+    async def _worker(self):
+        while True:
+            report_id = await self.queue.get()
+            report = self.pending[report_id]
+            try:
+                sent = await self._send(report[0])
+            except (ClientError, asyncio.TimeoutError):
+                sent = False
+            except Exception as e:
+                # Keep the worker alive, the report is retried like any other failure
+                print(f"Error reporting skipped segment {report[0]}: {e!r}")
+                sent = False
+            if sent:
+                del self.pending[report_id]
+                metrics.skip_reports.inc(result="sent")
+                self._schedule_save()
+                continue
+            report[1] += 1
+            if report[1] >= MAX_ATTEMPTS:
+                del self.pending[report_id]
+                metrics.skip_reports.inc(result="dropped")
+                self._schedule_save()
+                continue
+            metrics.skip_reports.inc(result="retried")
+            delay = min(RETRY_DELAY * 2 ** (report[1] - 1), MAX_RETRY_DELAY)
+            asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, report_id)
+
+    async def _send(self, uuid):
+        url = constants.SponsorBlock_api + "viewedVideoSponsorTime/"
+        async with self.web_session.post(url, params={"UUID": uuid}) as response:
+            await response.read()  # Releases the connection back to the pool
+            # Retry when rate limited or SponsorBlock is having trouble,
+            # other errors (unknown UUID) won't go away
+            return response.status != 429 and response.status < 500
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def _schedule_save(self):
+        if self.save_handle is None:
+            self.save_handle = asyncio.get_running_loop().call_later(SAVE_DELAY, self._save)
+
+    def _save(self):
+        self.save_handle = None
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump([uuid for uuid, _ in self.pending.values()], f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving pending skip reports to {self.path}: {e}")
+
+    async def close(self):
+        """Stops sending and saves what's left to send"""
+        if self.queue is None:
+            return
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+        self._save()
@@ -0,0 +1,205 @@
+import asyncio
+import time
+from collections import deque
+
+from . import metrics
+
+# Minimum time between two position requests to the device, in seconds
+MIN_RESYNC_SPACING = 1
+
+
+class SkipScheduler:
+    """Per device skip plan.
+    Holds the segments of the video that's playing and a single timer for the next
+    skip. Playback events move the timer instead of recreating tasks, segments are only
+    looked up when the video changes.
+
+    The position is predicted from the last one the device reported (the anchor).
+    Long waits and the last moments before a skip ask the device for its position
+    so stalls and buffering the device didn't report are corrected before seeking"""
+
+    def __init__(self, api_helper, lounge_controller, logger, calibrator, config):
+        self.api_helper = api_helper
+        self.lounge_controller = lounge_controller
+        self.logger = logger
+        self.calibrator = calibrator  # Provides the offset, learned or manual
+        # Seek right away when the skip is less than this many seconds away
+        self.accuracy_window = config.skip_accuracy_window / 1000  # Milliseconds in the config
+        # Ask the device for its position this many seconds before a skip
+        self.resync_lead = config.skip_resync_lead
+        # and at least this often while waiting for a skip
+        self.resync_interval = config.skip_resync_interval
+        self.video_id = None
+        self.segments = None  # SegmentIndex of video_id, None while it's being fetched
+        self.playing = False
+        self.position = 0.0  # Last position reported by the device
+        self.time_start = 0.0  # time.monotonic() when that position was received
+        self.last_resync = 0.0
+        self.skipped_since_anchor = False
+        self.fetch_task = None
+        self.timer = None
+        self.timer_due = 0.0  # loop.time() the timer should run at
+        self.tasks = set()
+        # Recorded so the offset and windows can be tuned from data, in seconds
+        self.timing_errors = deque(maxlen=100)  # How late each seek was sent
+        self.drift = deque(maxlen=100)  # Reported position minus the predicted one
+
+    # Called on every playback state change
+    def update(self, state, time_start):
+        self.calibrator.position_reported(state.currentTime, time_start)
+        playing = state.state.value == 1  # Playing
+        if (
+            playing
+            and self.playing
+            and state.videoId == self.video_id
+            and not self.skipped_since_anchor
+        ):
+            drift = state.currentTime - self.predicted_position(time_start)
+            self.drift.append(drift)
+            metrics.position_drift.observe(drift, device=self.lounge_controller.name)
+            self.logger.debug("Position drift: %.1f ms", drift * 1000)
+        self.playing = playing
+        self.position = state.currentTime
+        self.time_start = time_start
+        self.skipped_since_anchor = False
+        if state.videoId != self.video_id:
+            self.video_id = state.videoId
+            self.segments = None
+            self._cancel_timer()
+            if self.fetch_task:
+                self.fetch_task.cancel()
+                self.fetch_task = None
+            if state.videoId:
+                self.fetch_task = asyncio.create_task(self._load_segments(state.videoId))
+            return
+        if self.segments is not None:
+            self._log_playing()
+            self.time_to_segment()
+
+    async def _load_segments(self, video_id):
+        try:
+            segments = await self.api_helper.get_segments(video_id)
+        except Exception as e:
+            self.logger.error("Error getting segments for video %s: %s", video_id, e)
+            if video_id == self.video_id:
+                self.video_id = None  # Try again on the next event
+                self.fetch_task = None
+            return
+        if video_id != self.video_id:
+            return
+        self.segments = segments
+        self.fetch_task = None
+        self._log_playing()
+        self.time_to_segment()
+
+    def _log_playing(self):
+        if self.playing:
+            self.logger.info("Playing video %s with %d segments", self.video_id, len(self.segments))
+
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _track(self, coro):
+        # Keep a reference until it's done, a new event mustn't cancel a seek in flight
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _call_later(self, delay, callback, *args):
+        loop = asyncio.get_running_loop()
+        delay = max(delay, 0)
+        self.timer_due = loop.time() + delay
+        self.timer = loop.call_later(delay, callback, *args)
+
+    def _observe_lag(self):
+        lag = asyncio.get_running_loop().time() - self.timer_due
+        metrics.event_loop_lag.observe(lag, device=self.lounge_controller.name)
+
+    def predicted_position(self, now):
+        if not self.playing:
+            return self.position
+        return self.position + (now - self.time_start) * self.lounge_controller.playback_speed
+
+    # Finds the next segment to skip and (re)schedules the timer for it
+    def time_to_segment(self):
+        self._cancel_timer()
+        if not self.playing or not self.segments:
+            return
+        next_segment, start_next_segment = self.segments.next_segment(self.position)
+        if next_segment is None:
+            return
+        # When the segment starts (in time.monotonic()), as predicted from the anchor
+        target = (
+            self.time_start
+            + (start_next_segment - self.position) / self.lounge_controller.playback_speed
+            - self.calibrator.offset
+        )
+        now = time.monotonic()
+        remaining = target - now
+        if remaining <= self.accuracy_window:
+            self._fire(next_segment, target, from_timer=False)
+            return
+        wake = remaining  # Next resync, none if it's not before the skip
+        if self.resync_lead and remaining > self.resync_lead:
+            wake = remaining - self.resync_lead
+            # Interval resyncs leave room (MIN_RESYNC_SPACING) for the one before the skip
+            if self.resync_interval and self.resync_interval < wake - MIN_RESYNC_SPACING:
+                wake = self.resync_interval
+        elif self.resync_interval:
+            wake = min(wake, self.resync_interval)
+        wake = max(wake, MIN_RESYNC_SPACING - (now - self.last_resync))
+        if wake < remaining:
+            self._call_later(wake, self._resync, next_segment, target)
+        else:
+            self._call_later(remaining - self.accuracy_window / 2, self._fire, next_segment, target)
+
+    def _resync(self, segment, target):
+        # Ask the device where it really is, the reply re-anchors the schedule.
+        # Keep the current prediction in case it never arrives
+        self._observe_lag()
+        now = time.monotonic()
+        self.last_resync = now
+        self._track(self._request_position())
+        self._call_later(target - now - self.accuracy_window / 2, self._fire, segment, target)
+
+    async def _request_position(self):
+        try:
+            await self.lounge_controller.get_now_playing(resync=True)
+        except Exception as e:
+            self.logger.debug("Position resync failed: %s", e)
+
+    def _fire(self, segment, target, from_timer=True):
+        if from_timer:
+            self._observe_lag()
+        self.timer = None
+        self.skipped_since_anchor = True
+        error = time.monotonic() - target
+        self.timing_errors.append(error)
+        metrics.skip_timing_error.observe(error, device=self.lounge_controller.name)
+        self.logger.debug("Skip timing error: %.1f ms", error * 1000)
+        self._track(self.skip(segment.end, segment.uuids))
+
+    # Skips the segment by seeking to its end
+    async def skip(self, position, uuids):
+        self.logger.info("Skipping segment: seeking to %s", position)
+        await self._seek(position)
+        # Reported once the seek is done so it never competes with it
+        self.api_helper.mark_viewed_segments(uuids)
+
+    async def _seek(self, position):
+        time_sent = time.monotonic()
+        self.calibrator.seek_sent(position, time_sent)
+        await self.lounge_controller.seek_to(position)
+        self.calibrator.seek_done(time.monotonic() - time_sent)
+
+    def cancel(self):
+        """Stops the timer and every pending task, returns them to be awaited"""
+        self._cancel_timer()
+        tasks = list(self.tasks)
+        if self.fetch_task:
+            tasks.append(self.fetch_task)
+        for task in tasks:
+            task.cancel()
+        return tasks
@@ -0,0 +1,91 @@
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+# Seconds to wait before restarting a crashed shard, doubled on every crash in a row
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# A shard that ran this long before crashing is restarted right away
+STABLE_AFTER = 60
+# Seconds shards have to exit on shutdown before they're killed
+STOP_TIMEOUT = 10
+
+
+class Shard:
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = None  # time.monotonic() to restart it at, if it crashed
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+
+
+class Supervisor:
+    """Runs each shard in its own process and restarts the ones that crash.
+    A shard that exits cleanly (exit code 0) is left stopped"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.shards = []
+
+    def add(self, name, target, *args):
+        self.shards.append(Shard(name, target, args))
+
+    def run(self):
+        for shard in self.shards:
+            shard.start()
+        try:
+            while True:
+                running = [s for s in self.shards if s.process.is_alive()]
+                pending = [s for s in self.shards if s.restart_at is not None]
+                if not running and not pending:
+                    return
+                now = time.monotonic()
+                timeout = min((s.restart_at - now for s in pending), default=None)
+                wait([s.process.sentinel for s in running], timeout=timeout and max(timeout, 0))
+                self._check()
+        finally:
+            self.stop()
+
+    def _check(self):
+        now = time.monotonic()
+        for shard in self.shards:
+            if shard.restart_at is not None:
+                if now >= shard.restart_at:
+                    self.logger.info("Restarting %s", shard.name)
+                    shard.start()
+                continue
+            exitcode = shard.process.exitcode
+            if exitcode is None or exitcode == 0:
+                continue
+            if now - shard.started_at >= STABLE_AFTER:
+                shard.restart_delay = RESTART_DELAY
+            self.logger.error(
+                "%s exited with code %s, restarting it in %d seconds",
+                shard.name,
+                exitcode,
+                shard.restart_delay,
+            )
+            shard.restart_at = now + shard.restart_delay
+            shard.restart_delay = min(shard.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.restart_at = None
+            if shard.process.is_alive():
+                shard.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for shard in self.shards:
+            shard.process.join(max(deadline - time.monotonic(), 0))
+            if shard.process.is_alive():
+                self.logger.warning("%s didn't stop in time, killing it", shard.name)
+                shard.process.kill()
+                shard.process.join()
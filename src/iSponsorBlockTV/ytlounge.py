@@ -1,18 +1,57 @@
 import asyncio
 import json
 import sys
+import time
+from importlib.metadata import version
 from typing import Any, List
 
 import pyytlounge
-from aiohttp import ClientSession
+from aiohttp import ClientPayloadError, ClientSession, ClientTimeout
 
-from pyytlounge.wrapper import NotLinkedException, api_base, as_aiter, Dict
+from pyytlounge.util import iter_response_lines
+from pyytlounge.wrapper import NotConnectedException, NotLinkedException, api_base, as_aiter, Dict
 from uuid import uuid4
 
+from . import metrics
+from .command_dispatcher import CommandDispatcher
 from .constants import youtube_client_blacklist
+from .prefetch import Prefetcher
 
 create_task = asyncio.create_task
 
+# Seconds, polls shorter than this (errors, session ending) don't time the next ones
+MIN_POLL_LIFETIME = 10
+# Share of the server's poll lifetime after which a poll is replaced
+POLL_ROTATION = 0.9
+# Seconds a position resync waits for its reply, nowPlaying is news again after that
+RESYNC_REPLY_TIMEOUT = 5
+# subscribe and _read_poll use private parts of pyytlounge, checked against these releases
+PYYTLOUNGE_VERSIONS = ("2.3.",)
+PYYTLOUNGE_INTERNALS = (
+    "_parse_event_chunks",
+    "_process_events",
+    "_handle_session_result",
+    "_connection_lost",
+)
+
+
+def check_pyytlounge():
+    """Returns why the installed pyytlounge can't run the lounge stream, None if it can"""
+    installed = version("pyytlounge")
+    missing = [name for name in PYYTLOUNGE_INTERNALS if not hasattr(pyytlounge.YtLoungeApi, name)]
+    if installed.startswith(PYYTLOUNGE_VERSIONS) and not missing:
+        return None
+    return (
+        f"pyytlounge {installed} is not supported (expected"
+        f" {' or '.join(v + 'x' for v in PYYTLOUNGE_VERSIONS)}"
+        + (f", missing {', '.join(missing)}" if missing else "")
+        + "), install the version in requirements.txt"
+    )
+
+
+# Checked once, subscribe falls back to pyytlounge's own when set
+PYYTLOUNGE_UNSUPPORTED = check_pyytlounge()
+
 
 class YtLoungeApi(pyytlounge.YtLoungeApi):
     def __init__(
@@ -21,11 +60,18 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         config=None,
         api_helper=None,
         logger=None,
+        name=None,
     ):
         super().__init__(config.join_name if config else "iSponsorBlockTV", logger=logger)
         self.auth.screen_id = screen_id
         self.auth.lounge_id_token = None
         self.api_helper = api_helper
+        self.name = name  # Name of the device in the config, used to label metrics
+        self.prefetcher = None
+        if api_helper:
+            self.prefetcher = Prefetcher(
+                api_helper, logger, config.prefetch_depth if config else 3, name
+            )
         self.volume_state = {}
         self.playback_speed = 1.0
         self.subscribe_task = None
@@ -36,11 +82,16 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         self.auto_play = True
         self.watchdog_running = False
         self.last_event_time = 0
+        self.resync_pending = None  # Until then (time.monotonic()) nowPlaying may answer a resync
+        self.poll_rotation = True
+        self.poll_lifetime = None  # How long the server keeps a poll open, once seen
+        self.fallback_logged = False
         if config:
             self.mute_ads = config.mute_ads
             self.skip_ads = config.skip_ads
             self.auto_play = config.auto_play
-        self._command_mutex = asyncio.Lock()
+            self.poll_rotation = config.lounge_poll_rotation
+        self.dispatcher = CommandDispatcher(super()._command, logger, name)
 
     # Ensures that we still are subscribed to the lounge
     async def _watchdog(self):
@@ -63,6 +114,7 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
                     self.logger.debug(
                         f"Watchdog triggered: No events for {time_since_last_event:.1f} seconds"
                     )
+                    metrics.watchdog_triggers.inc(device=self.name)
 
                     # Cancel current subscription
                     if self.subscribe_task and not self.subscribe_task.done():
@@ -96,10 +148,107 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
             except (asyncio.CancelledError, Exception):
                 pass
 
-        self.subscribe_task = asyncio.create_task(super().subscribe(callback))
+        self.subscribe_task = asyncio.create_task(self.subscribe(callback))
         self.subscribe_task_watchdog = asyncio.create_task(self._watchdog())
         return self.subscribe_task
 
+    # Listens to the lounge on a series of long polls (bc/bind) of the same session.
+    # pyytlounge's subscribe returns when the server ends a poll, costing a whole
+    # reconnect (availability check, new session) before events flow again. Here the
+    # next poll is opened right away, and once the server's poll lifetime is known,
+    # a poll is replaced just before it would be cut off: the new one is open before
+    # the old one is dropped. Returns when the session is lost
+    async def subscribe(self, callback) -> None:
+        if PYYTLOUNGE_UNSUPPORTED:
+            if not self.fallback_logged:
+                self._logger.warning(
+                    "%s, reconnecting after every lounge poll", PYYTLOUNGE_UNSUPPORTED
+                )
+                self.fallback_logged = True
+            return await super().subscribe(callback)
+        if not self.connected():
+            raise NotConnectedException("Not connected")
+        self._logger.info("Subscribing to lounge id %s", self.auth.lounge_id_token)
+        resp = await self._open_poll()
+        if resp is None:
+            return
+        reader = create_task(self._read_poll(resp, callback))
+        opened = time.monotonic()
+        try:
+            while True:
+                timeout = None
+                if self.poll_rotation and self.poll_lifetime:
+                    rotate_at = opened + self.poll_lifetime * POLL_ROTATION
+                    timeout = max(rotate_at - time.monotonic(), 0)
+                done, _ = await asyncio.wait((reader,), timeout=timeout)
+                if done:
+                    await reader  # Raises what the poll raised
+                    if not self.connected():
+                        return
+                    lifetime = time.monotonic() - opened
+                    if lifetime >= MIN_POLL_LIFETIME:
+                        self.poll_lifetime = lifetime
+                    metrics.lounge_polls.inc(device=self.name, result="ended")
+                    gap_start = time.monotonic()
+                    next_resp = await self._open_poll()
+                    metrics.lounge_stream_gap.observe(
+                        time.monotonic() - gap_start, device=self.name
+                    )
+                    if next_resp is None:
+                        return
+                else:
+                    next_resp = await self._open_poll()
+                    if next_resp is None:
+                        if not self.connected():
+                            return
+                        self._logger.debug("Overlapping lounge poll refused, not rotating")
+                        self.poll_rotation = False
+                        continue
+                    reader.cancel()
+                    await asyncio.gather(reader, return_exceptions=True)
+                    resp.close()
+                    metrics.lounge_polls.inc(device=self.name, result="rotated")
+                resp = next_resp
+                reader = create_task(self._read_poll(resp, callback))
+                opened = time.monotonic()
+        finally:
+            reader.cancel()
+            resp.close()
+
+    async def _open_poll(self):
+        """Starts a long poll, returns the response once the server accepted it"""
+        params = {
+            **self._common_connection_parameters(),  # AID: events after the last one seen
+            "RID": "rpc",
+            "CI": "0",
+            "TYPE": "xmlhttp",
+        }
+        resp = await self.session.get(
+            url=f"{api_base}/bc/bind", params=params, timeout=ClientTimeout()
+        )
+        if not self._handle_session_result(resp.status, resp.reason) or resp.status != 200:
+            self._logger.info("Subscribe completed, status %i %s", resp.status, resp.reason)
+            resp.release()
+            return None
+        return resp
+
+    async def _read_poll(self, resp, callback):
+        try:
+            async for events in self._parse_event_chunks(iter_response_lines(resp.content)):
+                if self._last_event_id is not None:
+                    # Already seen on the poll this one replaced
+                    events = [event for event in events if event[0] > self._last_event_id]
+                    if not events:
+                        continue
+                pre_state_update = self.state_update
+                self._process_events(events)
+                if pre_state_update != self.state_update:
+                    await callback(self.state)
+                if not self.connected():
+                    break
+        except ClientPayloadError:
+            self._logger.debug("Lounge poll cut off, status %s %s", resp.status, resp.reason)
+
     # Process a lounge subscription event
     # skipcq: PY-R1000
     def _process_event(self, event_type: str, args: List[Any]):
@@ -118,10 +267,18 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
                 create_task(self.mute(False, override=True))
         elif event_type == "nowPlaying":
             data = args[0]
-            # Unmute when the video starts playing
-            if self.mute_ads and data.get("state", "0") == "1":
-                self.logger.info("Ad has ended, unmuting")
-                create_task(self.mute(False, override=True))
+            # A reply to a position resync only brings the position
+            if not self._is_resync_reply(data):
+                # Unmute when the video starts playing
+                if self.mute_ads and data.get("state", "0") == "1":
+                    self.logger.info("Ad has ended, unmuting")
+                    create_task(self.mute(False, override=True))
+                if self.prefetcher:
+                    self.prefetcher.playing(data.get("videoId"))
+                    self._plan_prefetch(data)
+        elif event_type == "playlistModified":
+            if self.prefetcher and args:
+                self._plan_prefetch(args[0])
         elif event_type == "onAdStateChange":
             data = args[0]
             if data["adState"] == "0" and data["currentTime"] != "0":  # Ad is not playing
@@ -143,16 +300,14 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         # Gets segments for the next video before it starts playing
         elif event_type == "autoplayUpNext":
             if len(args) > 0 and (vid_id := args[0]["videoId"]):  # if video id is not empty
-                self.logger.info(f"Getting segments for next video: {vid_id}")
-                create_task(self.api_helper.get_segments(vid_id))
+                self.prefetcher.add(vid_id, urgent=True)
 
         # #Used to know if an ad is skippable or not
         elif event_type == "adPlaying":
             data = args[0]
             # Gets segments for the next video (after the ad) before it starts playing
             if vid_id := data["contentVideoId"]:
-                self.logger.info(f"Getting segments for next video: {vid_id}")
-                create_task(self.api_helper.get_segments(vid_id))
+                self.prefetcher.add(vid_id, urgent=True)
 
             if (
                 self.skip_ads and data["isSkipEnabled"] == "true"
@@ -195,6 +350,17 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
 
         super()._process_event(event_type, args)
 
+    # Queues the videos after the current one in the lounge queue
+    def _plan_prefetch(self, data):
+        video_ids = data.get("videoIds")
+        if not video_ids:
+            return
+        try:
+            current_index = int(data.get("currentIndex", -1))
+        except ValueError:
+            return
+        self.prefetcher.queue(video_ids.split(","), current_index)
+
     # Set the volume to a specific value (0-100)
     async def set_volume(self, volume: int) -> None:
         await self._command("setVolume", {"volume": volume})
@@ -225,14 +391,29 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
     async def play_video(self, video_id: str) -> bool:
         return await self._command("setPlaylist", {"videoId": video_id})
 
-    async def get_now_playing(self):
-        return await self._command("getNowPlaying")
-
-    # Test to wrap the command function in a mutex to avoid race conditions with
-    # the _command_offset (TODO: move to upstream if it works)
+    async def get_now_playing(self, resync=False):
+        # The reply to a resync (asked by the skip scheduler) only updates the position
+        self.resync_pending = time.monotonic() + RESYNC_REPLY_TIMEOUT if resync else None
+        try:
+            return await self._command("getNowPlaying")
+        except BaseException:
+            self.resync_pending = None
+            raise
+
+    def _is_resync_reply(self, data):
+        # nowPlaying doesn't say what asked for it: a reply is the first one after a
+        # resync, in time and for the video that was playing. A new video is always news
+        deadline, self.resync_pending = self.resync_pending, None
+        return (
+            deadline is not None
+            and time.monotonic() < deadline
+            and data.get("videoId") == self.state.videoId
+        )
+
+    # Commands go through the dispatcher, one at a time to avoid race conditions with
+    # the _command_offset, and skips first
     async def _command(self, command: str, command_parameters: dict = None) -> bool:
-        async with self._command_mutex:
-            return await super()._command(command, command_parameters)
+        return await self.dispatcher.submit(command, command_parameters)
 
     async def change_web_session(self, web_session: ClientSession):
         if self.session is not None:
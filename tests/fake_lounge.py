@@ -0,0 +1,108 @@
+"""Local stand-in for the YouTube lounge (bc/bind) to test and benchmark the lounge
+stream offline. Only what the device loop uses is implemented: availability, new
+sessions, long polls that replay the events after AID, and commands that are recorded"""
+
+import asyncio
+import json
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+class FakeLounge:
+    def __init__(self, poll_lifetime=1.0, poll_delay=0.0, allow_overlap=True):
+        self.poll_lifetime = poll_lifetime  # Seconds before the server ends a poll
+        self.poll_delay = poll_delay  # Seconds before any request is answered
+        self.allow_overlap = allow_overlap  # Refuse a poll while another one is open
+        self.events = []  # (id, [type, *args], time.monotonic() when pushed)
+        self.polls = []  # AID of every poll accepted
+        self.open_polls = 0
+        self.overlapping = 0  # Polls accepted while another one was open (rotations)
+        self.refused = 0
+        self.commands = []
+        self.sessions = 0  # Sessions opened by connect
+        self.session_lost = False
+        self.changed = asyncio.Event()
+        self.server = None
+        self.api_base = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/lounge/bc/bind", self.poll)
+        app.router.add_post("/api/lounge/bc/bind", self.command)
+        app.router.add_post("/api/lounge/pairing/get_screen_availability", self.availability)
+        self.server = TestServer(app)
+        await self.server.start_server(access_log=None)
+        self.api_base = str(self.server.make_url("/api/lounge"))
+        return self
+
+    async def close(self):
+        await self.server.close()
+
+    def push(self, event_type, *args):
+        """Sends an event to the open polls (and the ones after, until it's seen)"""
+        self.events.append((len(self.events) + 1, [event_type, *args], time.monotonic()))
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def lose_session(self):
+        """The next poll is answered like an expired session"""
+        self.session_lost = True
+        self.changed.set()
+
+    async def poll(self, request):
+        await asyncio.sleep(self.poll_delay)
+        if self.session_lost:
+            return web.Response(status=400, reason="Unknown SID")
+        if self.open_polls and not self.allow_overlap:
+            self.refused += 1
+            return web.Response(status=503, reason="Busy")
+        aid = int(request.query.get("AID") or 0)
+        self.polls.append(aid)
+        if self.open_polls:
+            self.overlapping += 1
+        self.open_polls += 1
+        response = web.StreamResponse()
+        try:
+            await response.prepare(request)
+            sent = aid
+            end = time.monotonic() + self.poll_lifetime
+            while not self.session_lost:
+                new = [(i, event) for i, event, _ in self.events if i > sent]
+                if new:
+                    chunk = json.dumps(new)
+                    await response.write(f"{len(chunk) + 1}\n{chunk}\n".encode())
+                    sent = new[-1][0]
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        except ConnectionError:
+            pass  # The client dropped the poll
+        finally:
+            self.open_polls -= 1
+        return response
+
+    async def command(self, request):
+        data = await request.post()
+        if "req0__sc" not in data:
+            return await self.connect()
+        self.commands.append((data.get("req0__sc"), dict(data)))
+        return web.Response(text="OK")
+
+    async def connect(self):
+        # A new session only sends what happens from now on
+        await asyncio.sleep(self.poll_delay)
+        self.sessions += 1
+        self.session_lost = False
+        last = len(self.events)
+        chunk = json.dumps([[last, ["c", "sid"]], [last, ["S", "gsession"]]])
+        return web.Response(text=f"{len(chunk) + 1}\n{chunk}\n")
+
+    async def availability(self, request):
+        await asyncio.sleep(self.poll_delay)
+        return web.json_response({"screens": [{"status": "online"}]})
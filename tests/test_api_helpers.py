@@ -0,0 +1,82 @@
+import asyncio
+import types
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from iSponsorBlockTV import constants
+from iSponsorBlockTV.api_helpers import ApiHelper
+from iSponsorBlockTV.segment_store import SegmentStore
+
+
+def make_config(tmp_path, **options):
+    config = {
+        "apikey": "",
+        "skip_categories": ["sponsor", "intro"],
+        "channel_whitelist": [],
+        "skip_count_tracking": False,
+        "devices": [],
+        "minimum_skip_length": 1,
+        "segment_cache_server": "",
+        "sponsorblock_mirror": False,
+        "persistent_segment_cache": False,
+        "data_dir": str(tmp_path),
+        "segment_cache_ttl": 300,
+        "segment_cache_size": 100,
+        "segment_cache_policy": "lru",
+        "segment_cache_max_stale": 0,
+        "whitelist_cache_size": 100,
+    }
+    config.update(options)
+    return types.SimpleNamespace(**config)
+
+
+async def start_sponsorblock(monkeypatch, videos=()):
+    """Fake skipSegments/{prefix}, records the requests it answered"""
+    requests = []
+
+    async def skip_segments(request):
+        requests.append((request.match_info["prefix"], request.query.getall("category")))
+        if not videos:
+            return web.Response(status=404, text="Not Found")
+        return web.json_response(list(videos))
+
+    app = web.Application()
+    app.router.add_get("/api/skipSegments/{prefix}", skip_segments)
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(constants, "SponsorBlock_api", str(server.make_url("/api/")))
+    return server, requests
+
+
+def test_category_order_shares_the_bucket(monkeypatch, tmp_path):
+    async def run():
+        server, requests = await start_sponsorblock(monkeypatch)
+        async with ClientSession() as session:
+            api_helper = ApiHelper(make_config(tmp_path), session)
+            await api_helper.get_prefix_segments("abcd", ["sponsor", "intro"])
+            await api_helper.get_prefix_segments("abcd", ("intro", "sponsor", "intro"))
+        await server.close()
+        return requests
+
+    assert asyncio.run(run()) == [("abcd", ["intro", "sponsor"])]
+
+
+def test_videos_without_segments_are_stored(monkeypatch, tmp_path):
+    async def run():
+        server, requests = await start_sponsorblock(monkeypatch)
+        async with ClientSession() as session:
+            for _ in range(2):  # Restarts, with an empty memory cache
+                config = make_config(tmp_path, persistent_segment_cache=True)
+                api_helper = ApiHelper(config, session)
+                segments = await api_helper.get_segments("video")
+                api_helper.segment_store.close()
+        await server.close()
+        return segments, requests
+
+    segments, requests = asyncio.run(run())
+    assert len(segments) == 0
+    assert len(requests) == 1
+    stored = SegmentStore(str(tmp_path / constants.segment_store_file))
+    assert stored._connect().execute("SELECT expires_at FROM segments").fetchone()[0] is not None
+    stored.close()
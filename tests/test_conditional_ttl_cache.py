@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from iSponsorBlockTV import conditional_ttl_cache
+from iSponsorBlockTV.conditional_ttl_cache import AsyncConditionalTTL
+
+
+class Clock:
+    """Stands in for time.monotonic, moved by the tests"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(conditional_ttl_cache, "monotonic", clock)
+    return clock
+
+
+async def refreshed(cache):
+    """Waits for the background refreshes to finish"""
+    await asyncio.gather(*cache.pending.values(), return_exceptions=True)
+
+
+def make_cached(results, **kwargs):
+    """Cached function returning the next of results (raising it if it's an exception)"""
+    cache = AsyncConditionalTTL(**kwargs)
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return cache, cache(fetch), calls
+
+
+def test_values_expire_unless_ttl_is_ignored(clock):
+    async def run():
+        cache, get, calls = make_cached([("a", False), ("b", True), ("c", False)], time_to_live=5)
+        assert await get(1) == "a"
+        assert await get(2) == "b"
+        clock.now += 4.9
+        assert await get(1) == "a"
+        clock.now += 0.1
+        assert await get(1) == "c"  # Expired and fetched again
+        assert await get(2) == "b"  # Never expires
+        assert calls == [1, 2, 1]
+        assert cache.stats()["expirations"] == 1
+
+    asyncio.run(run())
+
+
+def test_concurrent_misses_are_coalesced():
+    async def run():
+        cache, get, calls = make_cached([("a", False)], time_to_live=60)
+        assert await asyncio.gather(get(1), get(1), get(1)) == ["a", "a", "a"]
+        assert calls == [1]
+        assert cache.stats()["coalesced"] == 2
+
+    asyncio.run(run())
+
+
+def test_failed_refresh_keeps_serving_the_stale_value(clock):
+    async def run():
+        cache, get, calls = make_cached(
+            [("a", False), RuntimeError("SponsorBlock is down"), ("b", False)],
+            time_to_live=5,
+            max_stale=60,
+        )
+        assert await get(1) == "a"
+        clock.now += 6
+        assert await get(1) == "a"  # Stale, refreshed in the background
+        await refreshed(cache)
+        assert cache.stats()["refresh_errors"] == 1
+        assert await get(1) == "a"  # Still there, refreshed again
+        await refreshed(cache)
+        assert await get(1) == "b"
+        assert calls == [1, 1, 1]
+
+    asyncio.run(run())
+
+
+def test_failed_misses_are_not_cached():
+    async def run():
+        cache, get, calls = make_cached([RuntimeError("down"), ("a", False)], time_to_live=60)
+        try:
+            await get(1)
+        except RuntimeError:
+            pass
+        assert len(cache.ttl) == 0
+        assert await get(1) == "a"
+
+    asyncio.run(run())
+
+
+def test_size_is_bounded():
+    async def run():
+        cache, get, _ = make_cached([(i, True) for i in range(10)], maxsize=3)
+        for i in range(10):
+            await get(i)
+        assert cache.stats()["size"] == 3
+        assert cache.stats()["evictions"] == 7
+
+    asyncio.run(run())
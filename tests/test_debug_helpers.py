@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from iSponsorBlockTV.debug_helpers import AiohttpTracer
+
+
+def trace_request(body_bytes, chunks, close_early=False):
+    """Traces a GET of a response streamed in chunks, returns its record.
+    close_early closes the response after its first chunk, like a rotated lounge poll"""
+
+    async def run():
+        async def handler(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for chunk in chunks:
+                await response.write(chunk)
+                await asyncio.sleep(0.01)  # Separate chunks on the client too
+            return response
+
+        app = web.Application()
+        app.router.add_get("/stream", handler)
+        server = TestServer(app)
+        await server.start_server()
+        tracer = AiohttpTracer(logging.getLogger("test"), body_bytes=body_bytes)
+        async with ClientSession(trace_configs=[tracer.trace_config()]) as session:
+            async with session.get(server.make_url("/stream?key=secret")) as resp:
+                if close_early:
+                    await resp.content.readany()
+                    resp.close()
+                else:
+                    await resp.read()
+            await asyncio.sleep(0)
+        await server.close()
+        (record,) = tracer.records
+        return record
+
+    return asyncio.run(run())
+
+
+def test_records_the_first_bytes_of_the_body():
+    record = trace_request(8, [b"abcde", b"fghij", b"klmno"])
+    assert record["body"] == "abcdefgh"
+    assert record["bytes"] == 15
+    assert record["status"] == 200
+    assert record["url"].endswith("/stream")  # Query strings are never recorded
+
+
+def test_body_shorter_than_the_limit():
+    assert trace_request(100, [b"abc", b"def"])["body"] == "abcdef"
+
+
+def test_no_body_unless_asked_for():
+    assert "body" not in trace_request(0, [b"abc"])
+
+
+def test_responses_closed_before_their_end_are_recorded():
+    record = trace_request(0, [b"abc", b"def", b"ghi"], close_early=True)
+    assert record["status"] == 200
+    assert 3 <= record["bytes"] < 9
+    assert record["total"] >= record["ttfb"]
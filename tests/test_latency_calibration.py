@@ -0,0 +1,32 @@
+from iSponsorBlockTV.latency_calibration import LatencyCalibrator, latency_path
+
+
+def calibrate(calibrator, latency, count):
+    for i in range(count):
+        calibrator.seek_sent(100.0 * i, 10.0 * i)
+        calibrator.seek_done(0.2)
+        calibrator.position_reported(100.0 * i, 10.0 * i + latency + 0.1)
+
+
+def test_learned_latency_replaces_the_offset_and_is_saved(tmp_path):
+    path = latency_path(str(tmp_path), "screen/1")
+    calibrator = LatencyCalibrator(path, "screen/1", 0.5)
+    assert calibrator.offset == 0.5  # Not enough samples yet
+    calibrate(calibrator, 0.3, 3)
+    assert abs(calibrator.offset - 0.3) < 1e-9
+    assert abs(LatencyCalibrator(path, "screen/1", 0.5).offset - 0.3) < 1e-9
+
+
+def test_devices_use_separate_files(tmp_path):
+    first = LatencyCalibrator(latency_path(str(tmp_path), "a"), "a", 0)
+    second = LatencyCalibrator(latency_path(str(tmp_path), "b"), "b", 0)
+    calibrate(first, 0.3, 3)
+    calibrate(second, 0.6, 3)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["latency_a.json", "latency_b.json"]
+    assert abs(LatencyCalibrator(latency_path(str(tmp_path), "a"), "a", 0).offset - 0.3) < 1e-9
+
+
+def test_disabled_keeps_the_manual_offset(tmp_path):
+    calibrator = LatencyCalibrator(latency_path(str(tmp_path), "a"), "a", 0.5, enabled=False)
+    calibrate(calibrator, 0.3, 3)
+    assert calibrator.offset == 0.5
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+import types
+
+import pytest
+import pyytlounge.wrapper
+from aiohttp import ClientSession
+from fake_lounge import FakeLounge
+
+from iSponsorBlockTV import ytlounge
+
+
+class RecordingLoungeApi(ytlounge.YtLoungeApi):
+    def __init__(self):
+        super().__init__("screen", None, None, logging.getLogger("test"), "tv")
+        self.mute_ads = False
+        self.skip_ads = False
+        self.received = []
+
+    def _process_event(self, event_type, args):
+        self.received.append(args[0])
+
+
+@pytest.fixture(autouse=True)
+def short_polls(monkeypatch):
+    monkeypatch.setattr(ytlounge, "MIN_POLL_LIFETIME", 0.1)
+
+
+async def start(monkeypatch, **lounge_options):
+    lounge = await FakeLounge(**lounge_options).start()
+    monkeypatch.setattr(ytlounge, "api_base", lounge.api_base)
+    monkeypatch.setattr(pyytlounge.wrapper, "api_base", lounge.api_base)
+    api = RecordingLoungeApi()
+    api.session = ClientSession()
+    api.auth.lounge_id_token = "token"
+    api._sid = "sid"
+    api._gsession = "gsession"
+    api._last_event_id = 0
+    return lounge, api
+
+
+async def stream(lounge, api, events, interval):
+    """Pushes events while subscribed, returns once the session is lost"""
+    task = asyncio.create_task(api.subscribe(None))
+    for i in range(events):
+        lounge.push("custom", i)
+        await asyncio.sleep(interval)
+    await asyncio.sleep(0.1)
+    lounge.lose_session()
+    await asyncio.wait_for(task, 2)
+    await api.session.close()
+    await lounge.close()
+
+
+def test_polls_rotate_and_resume_from_the_last_event(monkeypatch):
+    async def run():
+        lounge, api = await start(monkeypatch, poll_lifetime=0.3)
+        await stream(lounge, api, 60, 0.02)
+        return lounge, api
+
+    lounge, api = asyncio.run(run())
+    assert api.received == list(range(60))  # Nothing lost or seen twice
+    assert not api.connected()
+    assert api.poll_rotation
+    assert lounge.overlapping >= 2  # Replaced before the server ended them
+    assert len(lounge.polls) >= 4
+    assert lounge.polls == sorted(lounge.polls)
+    # Polls after the first resume from an event seen on the one before
+    assert lounge.polls[0] == 0
+    assert all(aid > 0 for aid in lounge.polls[2:])
+
+
+def test_events_between_polls_are_replayed(monkeypatch):
+    async def run():
+        # The first poll ends before the lifetime is learned, so the second one opens
+        # after it: the events pushed in between must come with it
+        lounge, api = await start(monkeypatch, poll_lifetime=0.2, poll_delay=0.05)
+        await stream(lounge, api, 30, 0.02)
+        return lounge, api
+
+    lounge, api = asyncio.run(run())
+    assert api.received == list(range(30))
+    assert len(lounge.polls) >= 2
+
+
+def test_refused_overlap_stops_rotation(monkeypatch):
+    async def run():
+        lounge, api = await start(monkeypatch, poll_lifetime=0.2, allow_overlap=False)
+        await stream(lounge, api, 40, 0.02)
+        return lounge, api
+
+    lounge, api = asyncio.run(run())
+    assert api.received == list(range(40))
+    assert lounge.refused == 1
+    assert lounge.overlapping == 0
+    assert not api.poll_rotation
+
+
+def test_unknown_session_ends_the_subscription(monkeypatch):
+    async def run():
+        lounge, api = await start(monkeypatch)
+        lounge.lose_session()
+        await asyncio.wait_for(api.subscribe(None), 2)
+        await api.session.close()
+        await lounge.close()
+        return api
+
+    api = asyncio.run(run())
+    assert not api.connected()
+
+
+def test_commands_reach_the_lounge(monkeypatch):
+    async def run():
+        lounge, api = await start(monkeypatch)
+        await api.seek_to(12.5)
+        await api.session.close()
+        await lounge.close()
+        return lounge
+
+    lounge = asyncio.run(run())
+    assert [command for command, _ in lounge.commands] == ["seekTo"]
+    assert lounge.commands[0][1]["req0_newTime"] == "12.5"
+
+
+def test_unsupported_pyytlounge_is_detected(monkeypatch):
+    assert ytlounge.check_pyytlounge() is None
+    monkeypatch.setattr(ytlounge, "version", lambda name: "3.0.0")
+    assert "pyytlounge 3.0.0" in ytlounge.check_pyytlounge()
+    monkeypatch.setattr(ytlounge, "version", lambda name: "2.3.0")
+    monkeypatch.delattr(pyytlounge.YtLoungeApi, "_connection_lost")
+    assert "missing _connection_lost" in ytlounge.check_pyytlounge()
+
+
+def test_unsupported_pyytlounge_falls_back_to_its_subscribe(monkeypatch, caplog):
+    monkeypatch.setattr(ytlounge, "PYYTLOUNGE_UNSUPPORTED", "pyytlounge 3.0.0 is not supported")
+
+    async def run():
+        lounge, api = await start(monkeypatch, poll_lifetime=0.2)
+        lounge.push("custom", 0)
+        await asyncio.wait_for(api.subscribe(None), 2)  # Returns once the poll ends
+        await api.session.close()
+        await lounge.close()
+        return lounge, api
+
+    lounge, api = asyncio.run(run())
+    assert api.received == [0]
+    assert lounge.polls == [0]
+    assert api.connected()
+    assert "pyytlounge 3.0.0 is not supported" in caplog.text
+
+
+def test_only_resync_replies_skip_the_new_video_handling():
+    played = []
+
+    async def run():
+        api = ytlounge.YtLoungeApi("screen", None, None, logging.getLogger("test"), "tv")
+        api.mute_ads = False
+        api.prefetcher = types.SimpleNamespace(playing=played.append)
+
+        def now_playing(video_id):
+            event = {"videoId": video_id, "currentTime": "1", "duration": "9", "state": "1"}
+            api._process_event("nowPlaying", [event])
+
+        now_playing("a")
+        api.resync_pending = time.monotonic() + 5
+        now_playing("a")  # Reply to the resync
+        api.resync_pending = time.monotonic() + 5
+        now_playing("b")  # Another video started before the reply
+        now_playing("b")  # The reply, after the flag was used
+        api.resync_pending = time.monotonic() - 1
+        now_playing("b")  # The reply never came
+
+    asyncio.run(run())
+    assert played == ["a", "b", "b", "b"]
@@ -0,0 +1,38 @@
+import pytest
+
+from iSponsorBlockTV.segment_mirror import MirrorImportError, SegmentMirror
+
+COLUMNS = "videoID,startTime,endTime,votes,locked,UUID,category,actionType,service,hidden"
+
+
+def dump(count):
+    lines = [COLUMNS]
+    for i in range(count):
+        lines.append(f"video{i},1.5,10,0,0,uuid{i},sponsor,skip,YouTube,0")
+    return [line + "\n" for line in lines]
+
+
+def rows(mirror):
+    return mirror._connect().execute("SELECT COUNT(*) FROM sponsor_times").fetchone()[0]
+
+
+def test_segments_gone_from_the_dump_are_deleted(tmp_path):
+    mirror = SegmentMirror(str(tmp_path / "mirror.sqlite3"))
+    assert mirror.import_csv(dump(20)) == (20, 0)
+    assert mirror.import_csv(dump(19)) == (19, 1)
+    assert rows(mirror) == 19
+    assert mirror.get("video0", ["sponsor"])["segments"][0]["UUID"] == "uuid0"
+    mirror.close()
+
+
+def test_truncated_dump_doesnt_wipe_the_mirror(tmp_path):
+    mirror = SegmentMirror(str(tmp_path / "mirror.sqlite3"))
+    mirror.import_csv(dump(20))
+    imported_at = mirror.imported_at()
+    with pytest.raises(MirrorImportError):
+        mirror.import_csv(dump(5))
+    assert rows(mirror) == 20
+    assert mirror.imported_at() == imported_at
+    assert mirror.import_csv(dump(5), force=True) == (5, 15)
+    assert rows(mirror) == 5
+    mirror.close()
@@ -0,0 +1,109 @@
+import copy
+import random
+
+from iSponsorBlockTV.api_helpers import ApiHelper
+from iSponsorBlockTV.segments import Segment, SegmentIndex
+
+CASES = 20000
+
+
+def old_process_segments(response, minimum_skip_length):
+    """process_segments before the single sweep merge (nested loops, mutates response)"""
+    segments = []
+    ignore_ttl = True
+    response_segments = response["segments"]
+    response_segments.sort(key=lambda x: x["segment"][1])
+    for i in response_segments:
+        for j in response_segments:
+            if j["segment"][0] <= i["segment"][1] <= j["segment"][1]:
+                i["segment"][1] = j["segment"][1]
+    response_segments.sort(key=lambda x: x["segment"][0])
+    for i in reversed(response_segments):
+        for j in reversed(response_segments):
+            if j["segment"][0] <= i["segment"][0] <= j["segment"][1]:
+                i["segment"][0] = j["segment"][0]
+    for i in response_segments:
+        ignore_ttl = ignore_ttl and i["locked"] == 1
+        segment = i["segment"]
+        segment_dict = {"start": segment[0], "end": segment[1], "UUID": [i["UUID"]]}
+        try:
+            segment_before_end = segments[-1]["end"]
+            segment_before_start = segments[-1]["start"]
+            segment_before_uuid = segments[-1]["UUID"]
+        except IndexError:
+            segment_before_end = -10
+        if segment_dict["start"] - segment_before_end < 1:
+            segment_dict["start"] = segment_before_start
+            segment_dict["UUID"].extend(segment_before_uuid)
+            segments.pop()
+        if segment_dict["end"] - segment_dict["start"] > minimum_skip_length:
+            segments.append(segment_dict)
+    return segments, ignore_ttl
+
+
+def old_next_segment(segments, position):
+    """time_to_segment's linear scan before SegmentIndex"""
+    for segment in segments:
+        is_within_start_range = position < 1 < segment.end and segment.start <= position
+        is_within_start_range = is_within_start_range and position < segment.end
+        if is_within_start_range or segment.start > position:
+            return segment, position if is_within_start_range else segment.start
+    return None, None
+
+
+def random_response(rng):
+    segments = []
+    for i in range(rng.randint(0, 12)):
+        start = round(rng.uniform(0, 60), 1)
+        segments.append(
+            {
+                "segment": [start, round(start + rng.uniform(0, 10), 1)],
+                "UUID": f"uuid{i}",
+                "category": rng.choice(("sponsor", "selfpromo")),
+                "locked": rng.choice((0, 1)),
+            }
+        )
+    return {"segments": segments}
+
+
+def test_process_segments_matches_old_algorithm():
+    rng = random.Random(0)
+    for _ in range(CASES):
+        response = random_response(rng)
+        minimum_skip_length = rng.choice((0, 1, 2))
+        untouched = copy.deepcopy(response)
+        segments, ignore_ttl = ApiHelper.process_segments(response, minimum_skip_length)
+        assert response == untouched  # The response isn't modified anymore
+        old_segments, old_ignore_ttl = old_process_segments(response, minimum_skip_length)
+        assert ignore_ttl == old_ignore_ttl
+        assert [(s.start, s.end, set(s.uuids)) for s in segments] == [
+            (s["start"], s["end"], set(s["UUID"])) for s in old_segments
+        ]
+
+
+def test_process_segments_returns_sorted_disjoint_segments():
+    rng = random.Random(1)
+    for _ in range(CASES):
+        segments, _ = ApiHelper.process_segments(random_response(rng), 0)
+        for before, after in zip(segments, segments[1:]):
+            assert after.start - before.end >= 1
+        for segment in segments:
+            assert isinstance(segment, Segment)
+            assert segment.start < segment.end
+
+
+def test_next_segment_matches_linear_scan():
+    rng = random.Random(2)
+    for _ in range(CASES):
+        segments, _ = ApiHelper.process_segments(random_response(rng), rng.choice((0, 1)))
+        index = SegmentIndex(segments)
+        position = rng.choice((round(rng.uniform(0, 80), 1), rng.uniform(0, 1.5)))
+        assert index.next_segment(position) == old_next_segment(segments, position)
+
+
+def test_next_segment_edges():
+    index = SegmentIndex([Segment(0.0, 5.0, ("a",), "sponsor", True)])
+    assert index.next_segment(0.0) == (index[0], 0.0)  # Starts right away
+    assert index.next_segment(0.5) == (index[0], 0.5)  # Video just started, inside it
+    assert index.next_segment(2.0) == (None, None)  # Already past the start
+    assert SegmentIndex().next_segment(0) == (None, None)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from iSponsorBlockTV import constants, skip_reporter
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(skip_reporter, "RETRY_DELAY", 0.01)
+    monkeypatch.setattr(skip_reporter, "SAVE_DELAY", 0.01)
+
+
+async def start_sponsorblock(monkeypatch, failures=0):
+    """Fake viewedVideoSponsorTime, answers 500 to the first failures requests"""
+    received = []
+    state = {"failures": failures}
+
+    async def viewed(request):
+        if state["failures"]:
+            state["failures"] -= 1
+            return web.Response(status=500)
+        received.append(request.query["UUID"])
+        return web.Response(text="OK")
+
+    app = web.Application()
+    app.router.add_post("/api/viewedVideoSponsorTime/", viewed)
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(constants, "SponsorBlock_api", str(server.make_url("/api/")))
+    return server, received, state
+
+
+def test_every_skip_is_reported(monkeypatch, tmp_path):
+    async def run():
+        server, received, _ = await start_sponsorblock(monkeypatch, failures=2)
+        async with ClientSession() as session:
+            reporter = skip_reporter.SkipReporter(session, str(tmp_path / "reports.json"))
+            reporter.report(["a", "b"])
+            reporter.report(["a"])  # Same segment skipped again
+            await asyncio.sleep(0.3)
+            await reporter.close()
+        await server.close()
+        return received
+
+    assert sorted(asyncio.run(run())) == ["a", "a", "b"]
+
+
+def test_unexpected_errors_dont_stop_the_workers(monkeypatch, tmp_path):
+    async def run():
+        server, received, _ = await start_sponsorblock(monkeypatch)
+        async with ClientSession() as session:
+            reporter = skip_reporter.SkipReporter(session, str(tmp_path / "reports.json"))
+            send = reporter._send
+            errors = iter((KeyError("UUID"), ValueError("bad JSON")))
+
+            async def flaky_send(uuid):
+                error = next(errors, None)
+                if error:
+                    raise error
+                return await send(uuid)
+
+            reporter._send = flaky_send
+            reporter.report(["a", "b", "c"])
+            await asyncio.sleep(0.3)
+            await reporter.close()
+        await server.close()
+        return received
+
+    assert sorted(asyncio.run(run())) == ["a", "b", "c"]
+
+
+def test_pending_reports_survive_a_restart(monkeypatch, tmp_path):
+    path = str(tmp_path / "reports.json")
+
+    async def run():
+        server, received, state = await start_sponsorblock(monkeypatch, failures=1000)
+        async with ClientSession() as session:
+            reporter = skip_reporter.SkipReporter(session, path)
+            reporter.report(["a", "a", "b"])
+            await asyncio.sleep(0.1)
+            await reporter.close()
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            state["failures"] = 0
+            reporter = skip_reporter.SkipReporter(session, path)
+            reporter.start()
+            await asyncio.sleep(0.1)
+            await reporter.close()
+        await server.close()
+        return saved, received
+
+    saved, received = asyncio.run(run())
+    assert sorted(saved) == ["a", "a", "b"]
+    assert sorted(received) == ["a", "a", "b"]
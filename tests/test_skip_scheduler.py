@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+import types
+
+from pyytlounge.models import State
+
+from iSponsorBlockTV import skip_scheduler
+from iSponsorBlockTV.latency_calibration import LatencyCalibrator
+from iSponsorBlockTV.segments import Segment, SegmentIndex
+from iSponsorBlockTV.skip_scheduler import SkipScheduler
+
+
+class FakeLounge:
+    name = "tv"
+    playback_speed = 1.0
+
+    def __init__(self):
+        self.seeks = []
+        self.resyncs = []
+        self.device = None  # Answers resyncs with its position when set
+
+    async def seek_to(self, position):
+        self.seeks.append((position, time.monotonic()))
+
+    async def get_now_playing(self, resync=False):
+        self.resyncs.append(time.monotonic())
+        if self.device:
+            self.device()
+
+
+class FakeApi:
+    def __init__(self, segments):
+        self.segments = SegmentIndex(segments)
+
+    async def get_segments(self, video_id):
+        return self.segments
+
+    def mark_viewed_segments(self, uuids):
+        pass
+
+
+def make_scheduler(segments, resync_lead=0, resync_interval=0):
+    config = types.SimpleNamespace(
+        skip_accuracy_window=50,
+        skip_resync_lead=resync_lead,
+        skip_resync_interval=resync_interval,
+    )
+    lounge = FakeLounge()
+    calibrator = LatencyCalibrator(None, "screen", 0, enabled=False)
+    scheduler = SkipScheduler(
+        FakeApi(segments), lounge, logging.getLogger("test"), calibrator, config
+    )
+    return scheduler, lounge
+
+
+def state(position, video_id="video"):
+    return types.SimpleNamespace(videoId=video_id, currentTime=position, state=State(1))
+
+
+def test_segment_starting_at_zero_is_skipped():
+    async def run():
+        scheduler, lounge = make_scheduler([Segment(0.0, 5.0, ("a",), "sponsor", True)])
+        scheduler.update(state(0.0), time.monotonic())
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*scheduler.cancel(), return_exceptions=True)
+        return lounge.seeks
+
+    assert [position for position, _ in asyncio.run(run())] == [5.0]
+
+
+def test_next_segment_is_skipped_on_time():
+    async def run():
+        scheduler, lounge = make_scheduler([Segment(10.2, 20.0, ("a",), "sponsor", True)])
+        start = time.monotonic()
+        scheduler.update(state(10.0), start)
+        while not lounge.seeks and time.monotonic() - start < 5:
+            await asyncio.sleep(0.005)
+        elapsed = time.monotonic() - start
+        await asyncio.gather(*scheduler.cancel(), return_exceptions=True)
+        return lounge.seeks, elapsed
+
+    seeks, elapsed = asyncio.run(run())
+    assert [position for position, _ in seeks] == [20.0]
+    # Timers never run early, a loaded machine only makes them late
+    assert 0.15 < elapsed < 2
+
+
+def test_resyncs_continue_until_the_skip(monkeypatch):
+    monkeypatch.setattr(skip_scheduler, "MIN_RESYNC_SPACING", 0.1)
+
+    async def run():
+        scheduler, lounge = make_scheduler(
+            [Segment(10.8, 20.0, ("a",), "sponsor", True)], resync_lead=0.15, resync_interval=0.2
+        )
+        start = time.monotonic()
+        # The device stalled for 100 ms right after reporting 10.0, each resync says so
+        lounge.device = lambda: scheduler.update(
+            state(10.0 + max(time.monotonic() - start - 0.1, 0)), time.monotonic()
+        )
+        scheduler.update(state(10.0), start)
+        while not lounge.seeks and time.monotonic() - start < 5:
+            await asyncio.sleep(0.005)
+        await asyncio.gather(*scheduler.cancel(), return_exceptions=True)
+        return lounge, start
+
+    lounge, start = asyncio.run(run())
+    (position, seek_time), *_ = lounge.seeks
+    resyncs = [resync - start for resync in lounge.resyncs]
+    # Every interval while waiting, then once more shortly before the skip
+    assert len(resyncs) >= 2  # 3 on time, the first reply doesn't end them
+    assert 0 < seek_time - start - resyncs[-1] < 1
+    # Skipped when the stalled device reached the segment, not when predicted at first
+    assert position == 20.0
+    assert seek_time - start > 0.85